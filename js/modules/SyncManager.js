@@ -164,7 +164,9 @@ export class SyncManager {
                 console.log(`Client ${msg.clientId} left ${msg.filename}`);
             },
             'operation_sync': (msg) => this.handleOperationSync(msg),
-            'operations_response': (msg) => this.handleOperationsResponse(msg)
+            'operations_response': (msg) => this.handleOperationsResponse(msg),
+            // Server coalesces messages queued behind a slow send into one frame
+            'batch': (msg) => msg.messages.forEach((queued) => this.handleMessage(queued))
         };
         
         SyncProtocol.routeMessage(message, handlers);
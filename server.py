@@ -4,879 +4,1614 @@ Custom HTTP server for twodo app that supports:
 - Serving static files
 - POST endpoint to save default.json
 """
+import _thread
+import collections
+import datetime
+import email.utils
+import functools
 import http.server
+import ipaddress
+import logging
+import logging.handlers
 import socketserver
 import json
+import mmap
+import operator
 import os
+import queue
+import re
+import selectors
+import shutil
+import signal
+import socket
+import struct
+import tempfile
+import threading
+import time
+from email.parser import HeaderParser
 from urllib.parse import urlparse, unquote
 import sys
 from http.server import ThreadingHTTPServer
 
-PORT = 8000
-if len(sys.argv) > 1:
-    PORT = int(sys.argv[1])
+# Usage: server.py [port] [--quiet | --verbose] [--workers=N]
+ARGS = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+PORT = int(ARGS[0]) if ARGS else 8000
+WORKERS = next((int(arg.split('=', 1)[1]) for arg in sys.argv[1:] if arg.startswith('--workers=')), 1)
+# TWODO_PERF=1 logs a [PERF] timing line for every /files/<name> load
+PERF = os.environ.get('TWODO_PERF') == '1'
+# TWODO_FSYNC=1 syncs each save to disk before it is renamed into place and
+# answered, instead of leaving the sync to the background thread
+SYNC_SAVES = os.environ.get('TWODO_FSYNC') == '1'
+
+log = logging.getLogger('twodo')
+
+# orjson is optional; fall back to the stdlib encoder when it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def json_dumps(obj, indent=False):
+    """Serialize obj to UTF-8 JSON bytes, pretty-printed with two spaces when indent is set"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    if indent:
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+if orjson is not None:
+    json_loads = orjson.loads
+else:
+    def json_loads(data):
+        """Parse JSON from str, bytes or a memoryview over a request buffer"""
+        if isinstance(data, memoryview):
+            data = bytes(data)
+        return json.loads(data)
+
+# Encoded /files response, keyed by the saved_files directory mtime
+listing_cache = {'mtime': None, 'body': b''}
+# Filesystems with coarse timestamps (2s on FAT) can change the directory twice
+# within one mtime tick, so a listing is only cached once the mtime is this old
+LISTING_SETTLE_NS = 2 * 10**9
+listing_lock = threading.Lock()
+
+# dist/index.html as last read, keyed by (inode, mtime, size)
+index_cache = {'key': None, 'body': b''}
+index_lock = threading.Lock()
+
+# Contents of recently served saved files (below the mmap threshold), most
+# recent last, keyed by (path, inode, mtime, size). Saves replace the file, so
+# a changed file gets a new inode and never matches a stale entry
+file_cache = collections.OrderedDict()
+file_cache_lock = threading.Lock()
+FILE_CACHE_ENTRIES = 32
+
+# Each worker thread keeps one request body buffer and grows it as needed
+request_buffers = threading.local()
+
+# Saved files are fsynced by a background thread so requests don't wait on the disk
+fsync_queue = queue.Queue()
+# On Windows fsync is FlushFileBuffers, which fails on a read-only handle
+FSYNC_OPEN_FLAGS = os.O_RDWR if os.name == 'nt' else os.O_RDONLY
+# Only the data has to be durable; fdatasync skips the inode timestamps
+fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+def fsync_worker():
+    """Flush queued paths to stable storage
+    
+    Paths queued while a flush is in progress are collected into one batch, so
+    a file saved several times in quick succession is synced once.
+    """
+    while True:
+        batch = {fsync_queue.get()}
+        while True:
+            try:
+                batch.add(fsync_queue.get_nowait())
+            except queue.Empty:
+                break
+        for path in batch:
+            try:
+                fd = os.open(path, FSYNC_OPEN_FLAGS)
+                try:
+                    fdatasync(fd)
+                finally:
+                    os.close(fd)
+            except FileNotFoundError:
+                # The file may already have been removed again
+                pass
+            except OSError as e:
+                log.warning("Could not fsync %s: %s", path, e)
+
+# NamedTemporaryFile creates files as 0600; uploads get the usual umask-based mode
+# instead. Read once at import, since os.umask can only be queried by setting it
+UMASK = os.umask(0)
+os.umask(UMASK)
+UPLOAD_FILE_MODE = 0o666 & ~UMASK
+
+# Windows refuses to rename over a file another handle has open (a concurrent GET,
+# an mmap, the websocket server reading it); such handles are short-lived, so retry
+REPLACE_RETRY_DELAYS = (0.01, 0.02, 0.05, 0.1, 0.2)
+
+def replace_file(src, dst):
+    """os.replace, retried briefly on Windows while dst is held open elsewhere"""
+    if os.name == 'nt':
+        for delay in REPLACE_RETRY_DELAYS:
+            try:
+                os.replace(src, dst)
+                return
+            except PermissionError:
+                time.sleep(delay)
+    os.replace(src, dst)
+
+def write_json_file(path, obj, fsync=True):
+    """Atomically write obj to path as indented JSON
+    
+    The payload goes to a temp file next to path and is renamed over it, so readers
+    and crashes never see a half-written document. The fsync is queued for
+    fsync_worker rather than done on the request thread, unless SYNC_SAVES asks
+    for the temp file to be synced before the rename.
+    """
+    payload = json_dumps(obj, indent=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+            if fsync and SYNC_SAVES:
+                # The data must reach the disk before the rename does, or a crash
+                # can leave the new name pointing at an empty file
+                f.flush()
+                fdatasync(f.fileno())
+        replace_file(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if fsync and not SYNC_SAVES:
+        fsync_queue.put(path)
+
+# Paths are resolved once; the handlers only ever join filenames onto them.
+# SCRIPT_DIR is absolute and normalized, so nothing derived from it needs abspath()
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DIST_DIR = os.path.join(SCRIPT_DIR, 'dist')
+SAVED_FILES_DIR = os.path.join(SCRIPT_DIR, 'saved_files')
+BUFFERS_DIR = os.path.join(SAVED_FILES_DIR, 'buffers')
+AUDIO_DIR = os.path.join(SAVED_FILES_DIR, 'recordings')
+TEST_LATEX_DIR = os.path.join(SCRIPT_DIR, '_test', 'latex')
+DEFAULT_JSON_PATH = os.path.join(SCRIPT_DIR, 'default.json')
+# Discovered LAN/Tailscale addresses, reused across restarts for ADDRESS_CACHE_TTL seconds
+ADDRESS_CACHE_PATH = os.path.join(SCRIPT_DIR, '.twodo_netcache.json')
+ADDRESS_CACHE_TTL = 300
+
+# Anything other than word characters, '.' and '-' is stripped from filenames
+UNSAFE_FILENAME_RE = re.compile(r'[^\w.-]')
+
+def sanitize_filename(filename):
+    """Strip directory components and unsafe characters from a client-supplied filename"""
+    return UNSAFE_FILENAME_RE.sub('', os.path.basename(filename))
+
+def normalize_filename(filename, allow_bak=False):
+    """Sanitize a client-supplied name for a saved JSON document, adding .json if missing
+    
+    With allow_bak, backup names ending in .bak are kept as they are.
+    """
+    filename = sanitize_filename(filename)
+    if filename.endswith('.json') or (allow_bak and filename.endswith('.bak')):
+        return filename
+    return filename + '.json'
+
+# Responses for these are marked no-store so edits to the app show up immediately
+NO_CACHE_EXTENSIONS = frozenset(('.html', '.css', '.js', '.json'))
+HTML_PATHS = frozenset(('', '/', '/index.html'))
+# Content types for the build output under /assets/, by lowercase extension
+ASSET_CONTENT_TYPES = {
+    '.js': 'application/javascript',
+    '.mjs': 'application/javascript',
+    '.css': 'text/css',
+    '.map': 'application/json',
+    '.wasm': 'application/wasm',
+    '.png': 'image/png',
+    '.svg': 'image/svg+xml',
+}
+
+def make_etag(st):
+    """Weak validator for a file's current contents, from its inode, mtime and size"""
+    # Saves replace the file, so the inode changes even when a same-size write
+    # lands within one mtime tick of the previous one
+    return f'W/"{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+# Allow data URIs for scripts (needed for some module loading scenarios);
+# <script> elements fall back to script-src when script-src-elem is absent,
+# connect-src allows WebSocket connections (ws:// and wss://)
+CSP_POLICY = "default-src 'self' 'unsafe-inline' 'unsafe-eval' https://cdn.jsdelivr.net data: blob: ws: wss: http://localhost:*; connect-src 'self' ws: wss: http://localhost:* https://cdn.jsdelivr.net; script-src 'self' 'unsafe-inline' 'unsafe-eval' https://cdn.jsdelivr.net data: blob:; style-src 'self' 'unsafe-inline';"
+
+# Header lines added to responses by policy_header_block(), pre-encoded
+CORS_HEADERS = (
+    b'Access-Control-Allow-Origin: *\r\n'
+    b'Access-Control-Allow-Methods: GET, POST, PUT, DELETE, OPTIONS\r\n'
+    b'Access-Control-Allow-Headers: Content-Type, Content-Length\r\n'
+)
+REVALIDATE_HEADERS = b'Cache-Control: no-cache\r\n'
+NO_STORE_HEADERS = (
+    b'Cache-Control: no-cache, no-store, must-revalidate\r\n'
+    b'Pragma: no-cache\r\n'
+    b'Expires: 0\r\n'
+)
+CSP_HEADER = b'Content-Security-Policy: ' + CSP_POLICY.encode('ascii') + b'\r\n'
+
+@functools.lru_cache(maxsize=256)
+def policy_header_block(clean_path):
+    """CORS, cache-control and CSP header lines for a path, as one bytes block"""
+    block = CORS_HEADERS
+    dot = clean_path.rfind('.')
+    extension = clean_path[dot:] if dot != -1 else ''
+    is_html_path = extension == '.html' or clean_path in HTML_PATHS
+    if clean_path.startswith(('/files/', '/assets/')) or clean_path in HTML_PATHS:
+        # Saved files, build assets and the index page carry an ETag: let the
+        # browser keep its copy but revalidate on every use so unchanged files
+        # come back as 304
+        block += REVALIDATE_HEADERS
+    elif is_html_path or extension in NO_CACHE_EXTENSIONS:
+        # No caching for HTML, CSS, JS and JSON so edits show up on reload
+        block += NO_STORE_HEADERS
+    if is_html_path:
+        block += CSP_HEADER
+    return block
+
+def url_path(target):
+    """Path component of a request target, without its query string or fragment"""
+    if not target.startswith('/'):
+        # Absolute-form or other unusual targets get the full parser
+        return urlparse(target).path
+    for separator in '?#':
+        end = target.find(separator)
+        if end != -1:
+            target = target[:end]
+    return target
+
+def dist_mtime_ns():
+    """Modification time of dist/, or None when there is no build"""
+    try:
+        return os.stat(DIST_DIR).st_mtime_ns
+    except OSError:
+        return None
+
+@functools.lru_cache(maxsize=1024)
+def resolve_dist_path(clean_path, dist_mtime):
+    """Absolute path of a file in dist/ for a URL path without its leading slash, or None
+    
+    dist_mtime only keys the cache: a rebuild replaces the entries of dist/ and
+    bumps its mtime, so resolutions from before the rebuild are never reused.
+    """
+    if clean_path == '' or clean_path == 'index.html':
+        dist_file = os.path.join(DIST_DIR, 'index.html')
+    else:
+        # Replace URL separators with OS separators for path joining, then
+        # normalize away any ../ segments
+        dist_file = os.path.normpath(os.path.join(DIST_DIR, clean_path.replace('/', os.sep)))
+        # Security check: ensure file is within dist/
+        # Use both forward and backslash for Windows compatibility
+        if not (dist_file.startswith(DIST_DIR + os.sep) or dist_file.startswith(DIST_DIR + '/')):
+            return None
+    return dist_file if os.path.isfile(dist_file) else None
+
+_http_date = (0, '')
+
+def http_date():
+    """Current Date header value, formatted at most once per second"""
+    global _http_date
+    now = int(time.time())
+    cached = _http_date
+    if cached[0] != now:
+        cached = _http_date = (now, email.utils.formatdate(now, usegmt=True))
+    return cached[1]
+
+class RepeatedErrorFilter(logging.Filter):
+    """Keep only the message line of an error whose traceback was logged recently
+    
+    A persistent fault that fails every request would otherwise format and
+    write a full traceback each time.
+    """
+    
+    def __init__(self, interval=60):
+        super().__init__()
+        self.interval = interval
+        self.last_logged = {}
+    
+    def filter(self, record):
+        if record.exc_info and record.exc_info[0] is not None:
+            key = (record.exc_info[0], str(record.exc_info[1]), record.pathname, record.lineno)
+            now = time.monotonic()
+            if now - self.last_logged.get(key, -self.interval) < self.interval:
+                record.exc_info = None
+                record.exc_text = None
+            else:
+                if len(self.last_logged) > 1000:
+                    self.last_logged.clear()
+                self.last_logged[key] = now
+        return True
+
+class TwodoServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer that runs connections on a bounded pool of daemon worker threads
+    
+    min_workers threads are started up front; more are added (up to max_workers)
+    whenever a connection arrives and no worker is idle. Workers are daemon threads,
+    like the ones ThreadingHTTPServer would spawn, so an in-flight request never
+    holds up interpreter exit.
+    
+    A connection only holds a worker while a request is in progress. Before its
+    first request and between keep-alive requests it is parked on a selector
+    watched by a single thread, which hands it to the pool once it is readable,
+    so idle browser connections and preconnects cost a file descriptor rather
+    than a thread.
+    
+    serve_forever() sleeps on the listening socket and a wakeup socketpair
+    rather than polling for shutdown() every half second.
+    """
+    allow_reuse_address = True
+    # Let the kernel queue a whole burst of browser connections while workers
+    # drain it; listen() clamps this to the system limit (net.core.somaxconn)
+    request_queue_size = socket.SOMAXCONN
+    min_workers = 8
+    max_workers = 64
+    # Set by fork_workers so every worker process can bind the same port
+    reuse_port = False
+    
+    def server_bind(self):
+        """Bind the listening socket, with SO_REUSEPORT when reuse_port is set
+        
+        socketserver only honours allow_reuse_port from Python 3.11 on, so the
+        option is set here directly.
+        """
+        if self.reuse_port and hasattr(socket, 'SO_REUSEPORT'):
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pending = queue.SimpleQueue()
+        self.workers = []
+        self.idle_workers = 0
+        self.workers_lock = threading.Lock()
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+        with self.workers_lock:
+            for _ in range(self.min_workers):
+                self._start_worker()
+        self.idle_selector = selectors.DefaultSelector()
+        self.idle_arrivals = []
+        self.idle_lock = threading.Lock()
+        self.idle_wakeup, self.idle_waker = socket.socketpair()
+        self.idle_selector.register(self.idle_wakeup, selectors.EVENT_READ)
+        threading.Thread(target=self._idle_loop, name='twodo-idle', daemon=True).start()
+        self.shutdown_requested = False
+        self.serve_stopped = threading.Event()
+        self.shutdown_wakeup, self.shutdown_waker = socket.socketpair()
+        self.shutdown_waker.setblocking(False)
+    
+    def serve_forever(self, poll_interval=None):
+        """Handle connections until shutdown() is called
+        
+        poll_interval is accepted for compatibility and ignored: shutdown()
+        wakes the selector directly.
+        """
+        self.serve_stopped.clear()
+        # A signal caught by another thread would leave the main thread asleep
+        # in select() with its Python handler (e.g. KeyboardInterrupt) pending;
+        # have the interpreter poke the wakeup socket so the handler runs
+        previous_wakeup_fd = None
+        if threading.current_thread() is threading.main_thread():
+            previous_wakeup_fd = signal.set_wakeup_fd(self.shutdown_waker.fileno())
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(self, selectors.EVENT_READ)
+                selector.register(self.shutdown_wakeup, selectors.EVENT_READ)
+                while not self.shutdown_requested:
+                    ready = selector.select()
+                    if self.shutdown_requested:
+                        break
+                    for key, _ in ready:
+                        if key.fileobj is self:
+                            self._handle_request_noblock()
+                        else:
+                            self.shutdown_wakeup.recv(4096)
+                    self.service_actions()
+        finally:
+            if previous_wakeup_fd is not None:
+                signal.set_wakeup_fd(previous_wakeup_fd)
+            self.shutdown_requested = False
+            self.serve_stopped.set()
+    
+    def shutdown(self):
+        """Stop serve_forever() and wait for it to return; call from another thread"""
+        self.shutdown_requested = True
+        try:
+            self.shutdown_waker.send(b'\0')
+        except OSError:
+            pass
+        self.serve_stopped.wait()
+    
+    def _start_worker(self):
+        # Called with workers_lock held
+        worker = threading.Thread(target=self._worker_loop, name=f'twodo-{len(self.workers)}', daemon=True)
+        self.workers.append(worker)
+        self.idle_workers += 1
+        worker.start()
+    
+    def _worker_loop(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            with self.workers_lock:
+                self.idle_workers -= 1
+            try:
+                self.process_request_thread(*item)
+            finally:
+                with self.workers_lock:
+                    self.idle_workers += 1
+    
+    def process_request(self, request, client_address):
+        """Park the new connection until its first request arrives, then hand it to the pool"""
+        with self.connections_lock:
+            self.connections.add(request)
+        # A worker taken now would sit in readline() until the client speaks,
+        # so idle preconnects could starve real requests of the bounded pool
+        self.park_connection(request, client_address)
+    
+    def _dispatch(self, request, client_address):
+        with self.workers_lock:
+            if self.idle_workers <= self.pending.qsize() and len(self.workers) < self.max_workers:
+                self._start_worker()
+        self.pending.put((request, client_address))
+    
+    def process_request_thread(self, request, client_address):
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+        else:
+            if handler.parked:
+                self.park_connection(request, client_address)
+                return
+        self.shutdown_request(request)
+    
+    def handle_error(self, request, client_address):
+        """Log a failed request through the twodo logger instead of printing to stderr"""
+        log.exception("Error handling request from %s", client_address[0])
+    
+    def park_connection(self, request, client_address):
+        """Hold an idle connection off the pool until its next (or first) request arrives"""
+        with self.idle_lock:
+            self.idle_arrivals.append((request, client_address))
+        self.idle_waker.send(b'\0')
+    
+    def _idle_loop(self):
+        idle_timeout = self.RequestHandlerClass.timeout
+        next_sweep = 0
+        while True:
+            for key, _ in self.idle_selector.select(timeout=1.0):
+                if key.fileobj is self.idle_wakeup:
+                    self.idle_wakeup.recv(4096)
+                    continue
+                # Data (or EOF) on a new or parked connection: a worker takes it from here
+                self.idle_selector.unregister(key.fileobj)
+                self._dispatch(key.fileobj, key.data[0])
+            
+            now = time.monotonic()
+            with self.idle_lock:
+                arrivals, self.idle_arrivals = self.idle_arrivals, []
+            for request, client_address in arrivals:
+                try:
+                    self.idle_selector.register(request, selectors.EVENT_READ, (client_address, now + idle_timeout))
+                except (ValueError, OSError):
+                    # Closed by server_close in the meantime
+                    self.shutdown_request(request)
+            
+            if now >= next_sweep:
+                next_sweep = now + 1.0
+                for key in list(self.idle_selector.get_map().values()):
+                    if key.data is not None and key.data[1] <= now:
+                        self.idle_selector.unregister(key.fileobj)
+                        self.shutdown_request(key.fileobj)
+    
+    def shutdown_request(self, request):
+        with self.connections_lock:
+            self.connections.discard(request)
+        super().shutdown_request(request)
+    
+    def server_close(self):
+        super().server_close()
+        # Wake workers parked on idle keep-alive connections so exit isn't held up
+        with self.connections_lock:
+            for request in self.connections:
+                try:
+                    request.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        for _ in self.workers:
+            self.pending.put(None)
+        self.shutdown_wakeup.close()
+        self.shutdown_waker.close()
 
 class TwodoHandler(http.server.SimpleHTTPRequestHandler):
+    # Buffer status line, headers and small bodies so they leave in one send()
+    wbufsize = 64 * 1024
+    # Keep connections open between the client's polling requests; every
+    # reply must therefore carry Content-Length (or be a 204/304)
+    protocol_version = 'HTTP/1.1'
+    # Drop connections that stay silent this long, whether parked (new or
+    # between keep-alive requests) or stalled mid-request on a worker
+    timeout = 30
+    # Status line and headers of the 405 reply, minus the terminating blank line
+    NOT_ALLOWED_RESPONSE = (
+        b'HTTP/1.1 405 Method Not Allowed\r\n'
+        b'Allow: GET, POST, PUT, DELETE, OPTIONS\r\n'
+        b'Access-Control-Allow-Origin: *\r\n'
+        b'Content-Length: 0\r\n'
+    )
+    # Complete CORS preflight reply, minus the terminating blank line
+    OPTIONS_RESPONSE = (
+        b'HTTP/1.1 204 No Content\r\n'
+        + CORS_HEADERS +
+        b'Access-Control-Max-Age: 86400\r\n'
+    )
+    # Fixed error replies, encoded once
+    FILE_NOT_FOUND_BODY = json_dumps({'success': False, 'error': 'File not found'})
+    FILE_EXISTS_BODY = json_dumps({'success': False, 'error': 'File already exists'})
+    # Saved files at least this large are sent from an mmap instead of a read() copy
+    mmap_threshold = 1024 * 1024
+    
     def __init__(self, *args, **kwargs):
-        self.request_path = None
+        self.url_path = None
+        self.parked = False
         super().__init__(*args, **kwargs)
     
+    def setup(self):
+        """Disable Nagle so small JSON responses are not held back by delayed ACKs"""
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    
     def translate_path(self, path):
         """Override to serve from dist/ if it exists, otherwise from root"""
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        dist_dir = os.path.join(script_dir, 'dist')
-        
         # Remove leading slash and query parameters
-        parsed_path = urlparse(path)
-        clean_path = parsed_path.path.lstrip('/')
+        clean_path = url_path(path).lstrip('/')
         
         # If dist/ exists, try to serve from there first
-        if os.path.exists(dist_dir) and os.path.isdir(dist_dir):
-            # Handle root/index.html
-            if clean_path == '' or clean_path == 'index.html':
-                dist_index = os.path.join(dist_dir, 'index.html')
-                if os.path.exists(dist_index):
-                    # Return absolute path - SimpleHTTPRequestHandler can handle this
-                    return os.path.abspath(dist_index)
-            else:
-                # Try to find the file in dist/
-                # Replace URL separators with OS separators for path joining
-                clean_path_os = clean_path.replace('/', os.sep)
-                dist_file = os.path.join(dist_dir, clean_path_os)
-                # Convert to absolute path and normalize
-                dist_file = os.path.abspath(os.path.normpath(dist_file))
-                dist_dir_abs = os.path.abspath(os.path.normpath(dist_dir))
-                
-                # Security check: ensure file is within dist_dir
-                # Use both forward and backslash for Windows compatibility
-                if (dist_file.startswith(dist_dir_abs + os.sep) or 
-                    dist_file.startswith(dist_dir_abs + '/') or 
-                    dist_file == dist_dir_abs):
-                    if os.path.exists(dist_file) and os.path.isfile(dist_file):
-                        # Return absolute path
-                        return dist_file
+        dist_mtime = dist_mtime_ns()
+        if dist_mtime is not None:
+            dist_file = resolve_dist_path(clean_path, dist_mtime)
+            if dist_file is not None:
+                # Return absolute path - SimpleHTTPRequestHandler can handle this
+                return dist_file
         
         # Fall back to root directory (uses current working directory from main())
         return super().translate_path(path)
     
+    def handle_one_request(self):
+        """Reset per-request state; one handler instance serves every request on a keep-alive connection"""
+        # path is only set once the request line parses; error replies sent
+        # before that (e.g. 414) still go through end_headers
+        self.path = ''
+        self.url_path = None
+        super().handle_one_request()
+    
+    def _url_path(self):
+        """Path component of the request target, parsed at most once per request"""
+        if self.url_path is None:
+            self.url_path = url_path(self.path)
+        return self.url_path
+    
+    def handle(self):
+        """Serve requests on this connection until it goes idle, then hand it back to the server
+        
+        The server only dispatches a connection once it is readable, so the
+        first request is already arriving; later ones are waited for parked.
+        """
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if not self._input_pending():
+                # Nothing buffered or on the wire: park instead of blocking a worker
+                self.parked = True
+                return
+            self.handle_one_request()
+    
+    def _input_pending(self):
+        """Return True if the next request has already started arriving"""
+        # With a zero timeout peek() returns whatever is buffered, or b'' rather
+        # than waiting for the socket
+        self.connection.settimeout(0.0)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+    
+    def copyfile(self, source, outputfile):
+        """Send static files with sendfile() so the kernel copies them straight to the socket"""
+        if outputfile is self.wfile:
+            # Headers are still sitting in the write buffer
+            outputfile.flush()
+            self.connection.sendfile(source)
+        else:
+            shutil.copyfileobj(source, outputfile, length=1024 * 1024)
+    
+    def _reply_json(self, code, obj, etag=None):
+        """Send a complete JSON response"""
+        self._reply_bytes(code, json_dumps(obj), etag=etag)
+    
+    def _reply_bytes(self, code, body, content_type='application/json', etag=None):
+        """Send status, headers and body together so they leave in one write"""
+        self._send_reply_headers(code, len(body), content_type, etag)
+        self.wfile.write(body)
+    
+    def _reply_wrapped_json(self, prefix, raw, suffix, etag=None):
+        """Send an already-encoded JSON document inside an envelope without re-parsing it"""
+        self._send_reply_headers(200, len(prefix) + len(raw) + len(suffix), 'application/json', etag)
+        self.wfile.write(prefix)
+        self.wfile.write(raw)
+        self.wfile.write(suffix)
+    
+    def _reply_wrapped_file(self, prefix, file_path, suffix, st, etag=None):
+        """Send a JSON file inside an envelope; large files are mapped rather than read into memory
+        
+        st is a recent stat of file_path, used to look the contents up in
+        file_cache. Returns the size of the file.
+        """
+        key = (file_path, st.st_ino, st.st_mtime_ns, st.st_size)
+        with file_cache_lock:
+            raw = file_cache.get(key)
+            if raw is not None:
+                file_cache.move_to_end(key)
+        if raw is not None:
+            self._reply_wrapped_json(prefix, raw, suffix, etag)
+            return len(raw)
+        with open(file_path, 'rb') as f:
+            # Key the entry by the file actually opened, which may have been
+            # replaced since the caller's stat
+            st = os.fstat(f.fileno())
+            if st.st_size < self.mmap_threshold:
+                raw = f.read()
+                with file_cache_lock:
+                    file_cache[(file_path, st.st_ino, st.st_mtime_ns, st.st_size)] = raw
+                    if len(file_cache) > FILE_CACHE_ENTRIES:
+                        file_cache.popitem(last=False)
+                self._reply_wrapped_json(prefix, raw, suffix, etag)
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    self._reply_wrapped_json(prefix, mapped, suffix, etag)
+                    self.wfile.flush()
+        return st.st_size
+    
+    def _send_reply_headers(self, code, length, content_type, etag, extra_headers=''):
+        """Write the status line and all headers as one pre-assembled block
+        
+        length and content_type may be None for bodiless replies such as 304;
+        extra_headers is a string of complete header lines.
+        """
+        self.log_request(code)
+        headers = f'{self.protocol_version} {code} {self.responses[code][0]}\r\n' \
+                  f'Server: {self.version_string()}\r\nDate: {http_date()}\r\n'
+        if content_type:
+            headers += f'Content-type: {content_type}\r\n'
+        if length is not None:
+            headers += f'Content-Length: {length}\r\n'
+        if etag:
+            headers += f'ETag: {etag}\r\n'
+        if code >= 400 and self.headers.get('Content-Length', '0') != '0':
+            # The request body may be only partly read, so the connection
+            # can't be reused for another request
+            self.close_connection = True
+            headers += 'Connection: close\r\n'
+        headers += extra_headers
+        self.wfile.write(headers.encode('latin-1') + policy_header_block(self._url_path()) + b'\r\n')
+    
+    def _reply_if_not_modified(self, etag):
+        """Answer 304 and return True when the client already holds this version"""
+        if_none_match = self.headers.get('If-None-Match')
+        if not if_none_match:
+            return False
+        if if_none_match.strip() != '*' and etag not in (tag.strip() for tag in if_none_match.split(',')):
+            return False
+        self._send_reply_headers(304, None, None, etag)
+        return True
+    
+    def _reply_not_allowed(self):
+        """Send the pre-encoded empty 405 listing the supported methods"""
+        self._reply_canned(405, self.NOT_ALLOWED_RESPONSE)
+    
+    def _reply_canned(self, code, response):
+        """Send a fixed, pre-encoded bodiless reply"""
+        self.log_request(code)
+        if self.headers.get('Content-Length', '0') != '0':
+            # The unread request body would otherwise be parsed as the next request
+            self.close_connection = True
+            self.wfile.write(response + b'Connection: close\r\n\r\n')
+        else:
+            self.wfile.write(response + b'\r\n')
+    
     def log_message(self, format, *args):
-        """Override to log all requests for debugging"""
-        print(f"{self.address_string()} - {format % args}")
+        """Route the request log through the twodo logger; formatting is skipped when INFO is off"""
+        log.info('%s - ' + format, self.address_string(), *args)
+    
+    def _content_length(self):
+        """Return the request's Content-Length, or reply 400 and return None when it is malformed
+        
+        Anything but plain ASCII digits is refused before a body buffer is touched;
+        a negative length would otherwise slice stale bytes out of the reused buffer.
+        """
+        value = self.headers.get('Content-Length', '0').strip()
+        if not (value.isascii() and value.isdigit()):
+            self._reply_json(400, {'success': False, 'error': 'Invalid Content-Length'})
+            return None
+        return int(value)
+    
+    def _read_body(self, length):
+        """Read exactly length body bytes into this thread's reusable buffer
+        
+        Returns a memoryview that stays valid until the thread reads its next body.
+        """
+        if length < 0:
+            raise ValueError("Negative Content-Length")
+        buf = getattr(request_buffers, 'buf', None)
+        if buf is None or len(buf) < length:
+            capacity = max(2 * len(buf) if buf else 64 * 1024, length + length // 10)
+            buf = request_buffers.buf = bytearray(capacity)
+        view = memoryview(buf)[:length]
+        received = 0
+        while received < length:
+            count = self.rfile.readinto(view[received:])
+            if not count:
+                raise ValueError("Request body ended before Content-Length bytes were read")
+            received += count
+        return view
+    
+    def _stream_multipart_upload(self, boundary, content_length, dest_dir):
+        """Stream the first file part of a multipart/form-data body into dest_dir
+        
+        The body is read in 64 KiB chunks and only enough bytes to spot a boundary
+        split across two reads are held back, so memory use stays flat no matter
+        how large the upload is. Returns (filename, temp_path, size).
+        """
+        # Every boundary after the first is preceded by CRLF; seed the buffer with
+        # one so the opening boundary matches the same delimiter
+        delimiter = b'\r\n' + boundary
+        keep = len(delimiter) + 1
+        buf = bytearray(b'\r\n')
+        # Socket reads land in one scratch buffer instead of a new bytes object per chunk
+        chunk = memoryview(bytearray(65536))
+        remaining = content_length
+        state = 'PREAMBLE'
+        filename = None
+        out = None
+        writing = False
+        size = 0
+        
+        try:
+            while True:
+                if remaining > 0:
+                    count = self.rfile.readinto(chunk[:min(len(chunk), remaining)])
+                    if not count:
+                        raise ValueError("Unexpected end of multipart body")
+                    remaining -= count
+                    buf += chunk[:count]
+                
+                while state != 'EPILOGUE':
+                    if state == 'HEADERS':
+                        header_end = buf.find(b'\r\n\r\n')
+                        if header_end == -1:
+                            break
+                        headers = bytes(buf[:header_end])
+                        del buf[:header_end + 4]
+                        # Only the first file part is kept; other fields are skipped
+                        part_filename = None
+                        if out is None:
+                            part = HeaderParser().parsestr(headers.decode('utf-8', errors='ignore'))
+                            part_filename = part.get_filename()
+                        writing = part_filename is not None
+                        if writing:
+                            filename = part_filename
+                            out = tempfile.NamedTemporaryFile(dir=dest_dir, prefix='.upload-', delete=False)
+                        state = 'BODY'
+                        continue
+                    
+                    # PREAMBLE or BODY: scan for the next boundary
+                    index = buf.find(delimiter)
+                    if index == -1 or len(buf) < index + len(delimiter) + 2:
+                        # Flush everything that cannot be the start of a boundary
+                        flush = len(buf) - keep if index == -1 else index
+                        if flush > 0:
+                            if writing:
+                                size += self._write_prefix(out, buf, flush)
+                            del buf[:flush]
+                        break
+                    
+                    if writing:
+                        size += self._write_prefix(out, buf, index)
+                        writing = False
+                    marker = buf[index + len(delimiter):index + len(delimiter) + 2]
+                    del buf[:index + len(delimiter) + 2]
+                    state = 'EPILOGUE' if marker == b'--' else 'HEADERS'
+                
+                if remaining == 0:
+                    break
+            
+            if out is None or size == 0:
+                raise ValueError("Failed to extract audio data from multipart form")
+            if state != 'EPILOGUE':
+                raise ValueError("Unexpected end of multipart body")
+            if SYNC_SAVES:
+                out.flush()
+                fdatasync(out.fileno())
+            out.close()
+            return filename, out.name, size
+        except Exception:
+            if out is not None:
+                out.close()
+                os.remove(out.name)
+            raise
+    
+    @staticmethod
+    def _write_prefix(out, buf, length):
+        """Write buf[:length] to out without copying it out of the bytearray"""
+        # The view must be released before the caller resizes buf
+        with memoryview(buf)[:length] as view:
+            out.write(view)
+        return length
     
     def do_POST(self):
         """Handle POST requests"""
-        print("=" * 50)
-        print("POST METHOD CALLED!")
-        print(f"Path: {self.path}")
-        print(f"Command: {self.command}")
-        print("=" * 50)
-        
         # Parse path to handle query parameters
-        parsed_path = urlparse(self.path)
-        path = parsed_path.path
-        print(f"POST request received: path={path}, full_path={self.path}, method={self.command}")
-        print(f"Headers: {dict(self.headers)}")
+        path = self._url_path()
+        log.debug("POST request received: path=%s, full_path=%s\n%s", path, self.path, self.headers)
         
-        if path == '/files/save' or path == '/files/save-as':
-            try:
-                script_dir = os.path.dirname(os.path.abspath(__file__))
-                saved_files_dir = os.path.join(script_dir, 'saved_files')
-                os.makedirs(saved_files_dir, exist_ok=True)
-                
-                content_length = int(self.headers.get('Content-Length', 0))
-                if content_length == 0:
-                    raise ValueError("No content length specified")
-                
-                post_data = self.rfile.read(content_length)
-                data = json.loads(post_data.decode('utf-8'))
-                
-                filename = data.get('filename', '')
-                file_data = data.get('data', {})
-                create_backup = data.get('createBackup', False)
-                
-                if not filename:
-                    raise ValueError("Filename is required")
-                
-                # Sanitize filename
-                filename = os.path.basename(filename)
-                filename = ''.join(c for c in filename if c.isalnum() or c in '.-_')
-                if not filename.endswith('.json'):
-                    filename += '.json'
-                
-                file_path = os.path.join(saved_files_dir, filename)
-                
-                # Create backup if requested (only for manual saves)
-                if create_backup and os.path.exists(file_path):
-                    backup_path = file_path + '.bak'
-                    try:
-                        import shutil
-                        shutil.copy2(file_path, backup_path)
-                        print(f"Backup created: {filename}.bak")
-                    except Exception as e:
-                        print(f"Warning: Failed to create backup: {e}")
-                
-                # Save file
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    json.dump(file_data, f, indent=2, ensure_ascii=False)
-                
-                print(f"File saved successfully: {filename}")
-                
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'success': True, 'message': f'File saved as {filename}', 'filename': filename}).encode('utf-8'))
-                
-            except Exception as e:
-                import traceback
-                print(f"Error saving file: {e}")
-                traceback.print_exc()
-                self.send_response(500)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'success': False, 'error': str(e)}).encode('utf-8'))
-        elif path == '/save-audio':
-            try:
-                # Get the directory where this script is located
-                script_dir = os.path.dirname(os.path.abspath(__file__))
-                saved_files_dir = os.path.join(script_dir, 'saved_files')
-                audio_dir = os.path.join(saved_files_dir, 'recordings')
-                
-                # Create recordings directory if it doesn't exist
-                os.makedirs(audio_dir, exist_ok=True)
-                
-                # Read the request body
-                content_length = int(self.headers.get('Content-Length', 0))
-                if content_length == 0:
-                    raise ValueError("No content length specified")
-                
-                # Parse multipart/form-data
-                content_type = self.headers.get('Content-Type', '')
-                if 'multipart/form-data' not in content_type:
-                    raise ValueError("Expected multipart/form-data")
-                
-                # Extract boundary
-                boundary_str = None
-                for part in content_type.split(';'):
-                    part = part.strip()
-                    if part.startswith('boundary='):
-                        boundary_str = part[len('boundary='):].strip('"')
-                        break
-                
-                if not boundary_str:
-                    raise ValueError("No boundary found in Content-Type")
-                
-                boundary = ('--' + boundary_str).encode()
-                
-                # Read the entire body
-                post_data = self.rfile.read(content_length)
-                
-                # Parse multipart data
-                parts = post_data.split(boundary)
-                
-                filename = None
-                audio_data = None
-                
-                for part in parts:
-                    if b'Content-Disposition' in part:
-                        # Extract filename
-                        if b'filename=' in part:
-                            # Find filename in the part
-                            filename_match_start = part.find(b'filename="')
-                            if filename_match_start != -1:
-                                filename_start = filename_match_start + len(b'filename="')
-                                filename_end = part.find(b'"', filename_start)
-                                if filename_end != -1:
-                                    filename = part[filename_start:filename_end].decode('utf-8', errors='ignore')
-                        
-                        # Extract audio data (after the headers, before the next boundary)
-                        header_end = part.find(b'\r\n\r\n')
-                        if header_end != -1:
-                            audio_data = part[header_end + 4:]
-                            # Remove trailing CRLF and boundary markers
-                            while audio_data.endswith(b'\r\n') or audio_data.endswith(b'--'):
-                                if audio_data.endswith(b'\r\n--'):
-                                    audio_data = audio_data[:-4]
-                                elif audio_data.endswith(b'--'):
-                                    audio_data = audio_data[:-2]
-                                elif audio_data.endswith(b'\r\n'):
-                                    audio_data = audio_data[:-2]
-                                else:
-                                    break
-                
-                if not filename:
-                    # Generate filename if not provided
-                    import datetime
-                    timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
-                    filename = f'recording-{timestamp}.webm'
-                
-                if not audio_data or len(audio_data) == 0:
-                    raise ValueError("Failed to extract audio data from multipart form")
-                
-                # Sanitize filename
-                filename = os.path.basename(filename)  # Prevent directory traversal
-                # Remove any dangerous characters
-                filename = ''.join(c for c in filename if c.isalnum() or c in '.-_')
-                if not filename.endswith('.webm'):
-                    filename += '.webm'
-                
-                # Save audio file
-                audio_path = os.path.join(audio_dir, filename)
-                with open(audio_path, 'wb') as f:
-                    f.write(audio_data)
-                
-                print(f"Audio saved successfully: {filename} ({len(audio_data)} bytes)")
-                
-                # Send success response
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'success': True, 'message': f'Audio saved as {filename}', 'filename': filename}).encode('utf-8'))
-                
-            except Exception as e:
-                # Log error for debugging
-                import traceback
-                print(f"Error saving audio: {e}")
-                traceback.print_exc()
-                # Send error response
-                self.send_response(500)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'success': False, 'error': str(e)}).encode('utf-8'))
-        elif path == '/save-default.json':
-            try:
-                # Get the directory where this script is located
-                script_dir = os.path.dirname(os.path.abspath(__file__))
-                default_json_path = os.path.join(script_dir, 'default.json')
-                
-                # Read the request body
-                content_length = int(self.headers.get('Content-Length', 0))
-                if content_length == 0:
-                    raise ValueError("No content length specified")
-                post_data = self.rfile.read(content_length)
-                
-                # Parse JSON
-                data = json.loads(post_data.decode('utf-8'))
-                
-                # Write to default.json
-                with open(default_json_path, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, indent=2, ensure_ascii=False)
-                
-                # Send success response
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'success': True, 'message': 'default.json saved successfully'}).encode('utf-8'))
-                
-            except Exception as e:
-                # Log error for debugging
-                import traceback
-                print(f"Error saving default.json: {e}")
-                traceback.print_exc()
-                # Send error response
-                self.send_response(500)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'success': False, 'error': str(e)}).encode('utf-8'))
-        elif path == '/files/buffer/save':
-            try:
-                script_dir = os.path.dirname(os.path.abspath(__file__))
-                saved_files_dir = os.path.join(script_dir, 'saved_files')
-                buffers_dir = os.path.join(saved_files_dir, 'buffers')
-                os.makedirs(buffers_dir, exist_ok=True)
-                
-                content_length = int(self.headers.get('Content-Length', 0))
-                if content_length == 0:
-                    raise ValueError("No content length specified")
-                
-                post_data = self.rfile.read(content_length)
-                data = json.loads(post_data.decode('utf-8'))
-                
-                filename = data.get('filename', '')
-                buffer_data = data.get('buffer', {})
-                
-                if not filename:
-                    raise ValueError("Filename is required")
-                
-                # Sanitize filename
-                filename = os.path.basename(filename)
-                filename = ''.join(c for c in filename if c.isalnum() or c in '.-_')
-                if not filename.endswith('.json'):
-                    filename += '.json'
-                
-                file_path = os.path.join(buffers_dir, filename)
-                
-                # Save buffer file
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    json.dump(buffer_data, f, indent=2, ensure_ascii=False)
-                
-                print(f"Buffer file saved successfully: {filename}")
-                
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'success': True, 'filename': filename}).encode('utf-8'))
-                
-            except Exception as e:
-                import traceback
-                print(f"Error saving buffer file: {e}")
-                traceback.print_exc()
-                self.send_response(500)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'success': False, 'error': str(e)}).encode('utf-8'))
-        else:
+        handler = self._POST_ROUTES.get(path)
+        if handler is None:
             # Log 404 for debugging
-            print(f"POST request to unknown path: {path}")
-            self.send_response(404)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({'success': False, 'error': f'Path not found: {path}'}).encode('utf-8'))
+            log.warning("POST request to unknown path: %s", path)
+            self._reply_json(404, {'success': False, 'error': f'Path not found: {path}'})
+            return
+        handler(self)
+    
+    def _save_file(self):
+        """POST /files/save and /files/save-as"""
+        try:
+            content_length = self._content_length()
+            if content_length is None:
+                return
+            if content_length == 0:
+                raise ValueError("No content length specified")
+            
+            post_data = self._read_body(content_length)
+            data = json_loads(post_data)
+            
+            filename = data.get('filename', '')
+            file_data = data.get('data', {})
+            create_backup = data.get('createBackup', False)
+            
+            if not filename:
+                raise ValueError("Filename is required")
+            
+            # Sanitize filename
+            filename = normalize_filename(filename)
+            
+            file_path = os.path.join(SAVED_FILES_DIR, filename)
+            
+            # Create backup if requested (only for manual saves)
+            if create_backup and os.path.exists(file_path):
+                backup_path = file_path + '.bak'
+                try:
+                    shutil.copy2(file_path, backup_path)
+                    log.info("Backup created: %s.bak", filename)
+                except Exception as e:
+                    log.warning("Failed to create backup: %s", e)
+            
+            # Save file
+            write_json_file(file_path, file_data)
+            
+            log.info("File saved successfully: %s", filename)
+            
+            self._reply_json(200, {'success': True, 'message': f'File saved as {filename}', 'filename': filename})
+            
+        except Exception as e:
+            log.exception("Error saving file: %s", e)
+            self._reply_json(500, {'success': False, 'error': str(e)})
+    
+    def _save_audio(self):
+        """POST /save-audio"""
+        try:
+            # Read the request body
+            content_length = self._content_length()
+            if content_length is None:
+                return
+            if content_length == 0:
+                raise ValueError("No content length specified")
+            
+            # Parse multipart/form-data
+            if self.headers.get_content_type() != 'multipart/form-data':
+                raise ValueError("Expected multipart/form-data")
+            
+            boundary_str = self.headers.get_boundary()
+            if not boundary_str:
+                raise ValueError("No boundary found in Content-Type")
+            
+            boundary = ('--' + boundary_str).encode()
+            
+            # Stream the file part straight to a temp file in the recordings directory
+            filename, temp_path, audio_size = self._stream_multipart_upload(boundary, content_length, AUDIO_DIR)
+            
+            if not filename:
+                # Generate filename if not provided
+                timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+                filename = f'recording-{timestamp}.webm'
+            
+            # Sanitize filename
+            filename = sanitize_filename(filename)
+            if not filename.endswith('.webm'):
+                filename += '.webm'
+            
+            # Move the finished upload into place
+            audio_path = os.path.join(AUDIO_DIR, filename)
+            os.chmod(temp_path, UPLOAD_FILE_MODE)
+            replace_file(temp_path, audio_path)
+            if not SYNC_SAVES:
+                fsync_queue.put(audio_path)
+            
+            log.info("Audio saved successfully: %s (%s bytes)", filename, audio_size)
+            
+            # Send success response
+            self._reply_json(200, {'success': True, 'message': f'Audio saved as {filename}', 'filename': filename})
+            
+        except Exception as e:
+            # Log error for debugging
+            log.exception("Error saving audio: %s", e)
+            # Send error response
+            self._reply_json(500, {'success': False, 'error': str(e)})
+    
+    def _save_default(self):
+        """POST /save-default.json"""
+        try:
+            # Read the request body
+            content_length = self._content_length()
+            if content_length is None:
+                return
+            if content_length == 0:
+                raise ValueError("No content length specified")
+            post_data = self._read_body(content_length)
+            
+            # Parse JSON
+            data = json_loads(post_data)
+            
+            # Write to default.json
+            write_json_file(DEFAULT_JSON_PATH, data)
+            
+            # Send success response
+            self._reply_json(200, {'success': True, 'message': 'default.json saved successfully'})
+            
+        except Exception as e:
+            # Log error for debugging
+            log.exception("Error saving default.json: %s", e)
+            # Send error response
+            self._reply_json(500, {'success': False, 'error': str(e)})
+    
+    def _save_buffer(self):
+        """POST /files/buffer/save"""
+        try:
+            content_length = self._content_length()
+            if content_length is None:
+                return
+            if content_length == 0:
+                raise ValueError("No content length specified")
+            
+            post_data = self._read_body(content_length)
+            data = json_loads(post_data)
+            
+            filename = data.get('filename', '')
+            buffer_data = data.get('buffer', {})
+            
+            if not filename:
+                raise ValueError("Filename is required")
+            
+            # Sanitize filename
+            filename = normalize_filename(filename)
+            
+            file_path = os.path.join(BUFFERS_DIR, filename)
+            
+            # Save buffer file
+            write_json_file(file_path, buffer_data)
+            
+            log.info("Buffer file saved successfully: %s", filename)
+            
+            self._reply_json(200, {'success': True, 'filename': filename})
+            
+        except Exception as e:
+            log.exception("Error saving buffer file: %s", e)
+            self._reply_json(500, {'success': False, 'error': str(e)})
+    
+    _POST_ROUTES = {
+        '/files/save': _save_file,
+        '/files/save-as': _save_file,
+        '/save-audio': _save_audio,
+        '/save-default.json': _save_default,
+        '/files/buffer/save': _save_buffer,
+    }
     
     def do_GET(self):
-        """Handle GET requests (serve static files)"""
-        # Handle favicon.ico requests to avoid 404 errors
-        parsed_path = urlparse(self.path)
-        path = parsed_path.path
+        """Handle GET requests (API routes first, then static files)"""
+        path = self._url_path()
         
-        if path == '/favicon.ico':
-            # Return 204 No Content to suppress the error
-            self.send_response(204)
-            self.end_headers()
+        handler = self._GET_ROUTES.get(path)
+        if handler is None:
+            for prefix, route in self._GET_PREFIX_ROUTES:
+                if path.startswith(prefix):
+                    handler = route
+                    break
+        if handler is not None:
+            handler(self, path)
             return
         
-        # Handle /assets/ requests from dist/ directory
-        if path.startswith('/assets/'):
-            script_dir = os.path.dirname(os.path.abspath(__file__))
-            dist_dir = os.path.join(script_dir, 'dist')
-            if os.path.exists(dist_dir):
-                # Get the file path relative to dist/
-                file_path = path[1:]  # Remove leading /
-                file_path_os = file_path.replace('/', os.sep)
-                dist_file = os.path.join(dist_dir, file_path_os)
-                dist_file = os.path.abspath(os.path.normpath(dist_file))
-                dist_dir_abs = os.path.abspath(os.path.normpath(dist_dir))
-                
-                # Security check
-                if (dist_file.startswith(dist_dir_abs + os.sep) or 
-                    dist_file.startswith(dist_dir_abs + '/') or 
-                    dist_file == dist_dir_abs):
-                    if os.path.exists(dist_file) and os.path.isfile(dist_file):
-                        try:
-                            # Read and serve the file
-                            with open(dist_file, 'rb') as f:
-                                content = f.read()
-                            
-                            # Determine content type
-                            if dist_file.endswith('.js'):
-                                content_type = 'application/javascript'
-                            elif dist_file.endswith('.css'):
-                                content_type = 'text/css'
-                            elif dist_file.endswith('.map'):
-                                content_type = 'application/json'
-                            else:
-                                content_type = 'application/octet-stream'
-                            
-                            self.send_response(200)
-                            self.send_header('Content-type', content_type)
-                            self.send_header('Content-Length', str(len(content)))
-                            self.send_header('Access-Control-Allow-Origin', '*')
-                            self.end_headers()
-                            self.wfile.write(content)
-                            self.wfile.flush()
-                            return
-                        except Exception as e:
-                            print(f"Error serving asset {dist_file}: {e}")
-                            import traceback
-                            traceback.print_exc()
-                            self.send_response(500)
-            self.end_headers()
+        # Add cache-busting query parameter handling for default.json
+        if self.path.startswith('/default.json'):
+            # Remove query parameters for file lookup
+            self.path = path
+            
+        return super().do_GET()
+    
+    def _get_favicon(self, path):
+        """GET /favicon.ico"""
+        # Return 204 No Content to suppress the error
+        self._send_reply_headers(204, None, None, None)
+    
+    def _get_index(self, path):
+        """GET / and /index.html, served from memory while dist/index.html is unchanged"""
+        dist_mtime = dist_mtime_ns()
+        dist_index = resolve_dist_path('', dist_mtime) if dist_mtime is not None else None
+        try:
+            st = os.stat(dist_index) if dist_index is not None else None
+        except FileNotFoundError:
+            st = None
+        if st is None:
+            # No build: serve the source index.html from the root as a static file
+            super().do_GET()
             return
         
-        # Handle file management endpoints
-        if path == '/files':
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with index_lock:
+            if index_cache['key'] != key:
+                with open(dist_index, 'rb') as f:
+                    index_cache['body'] = f.read()
+                index_cache['key'] = key
+            body = index_cache['body']
+        etag = make_etag(st)
+        if not self._reply_if_not_modified(etag):
+            self._reply_bytes(200, body, 'text/html', etag)
+    
+    def _get_asset(self, path):
+        """GET /assets/* from the dist/ build"""
+        dist_mtime = dist_mtime_ns()
+        dist_file = resolve_dist_path(path[1:], dist_mtime) if dist_mtime is not None else None
+        if dist_file is not None:
             try:
-                script_dir = os.path.dirname(os.path.abspath(__file__))
-                saved_files_dir = os.path.join(script_dir, 'saved_files')
-                os.makedirs(saved_files_dir, exist_ok=True)
-                
-                # List all JSON files (exclude backup files with .bak extension)
-                files = []
-                if os.path.exists(saved_files_dir):
-                    for filename in os.listdir(saved_files_dir):
-                        if filename.endswith('.json') and not filename.endswith('.bak'):
-                            file_path = os.path.join(saved_files_dir, filename)
-                            stat = os.stat(file_path)
-                            files.append({
-                                'filename': filename,
-                                'size': stat.st_size,
-                                'modified': stat.st_mtime
-                            })
-                
-                # Sort by modified time (newest first)
-                files.sort(key=lambda x: x['modified'], reverse=True)
-                
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'success': True, 'files': files}).encode('utf-8'))
-                return
-                
+                content_type = ASSET_CONTENT_TYPES.get(os.path.splitext(dist_file)[1].lower(), 'application/octet-stream')
+                f = open(dist_file, 'rb')
+                st = os.fstat(f.fileno())
+            except FileNotFoundError:
+                # Removed since it was resolved, e.g. by a rebuild in progress
+                pass
             except Exception as e:
-                import traceback
-                print(f"Error listing files: {e}")
-                traceback.print_exc()
-                self.send_response(500)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'success': False, 'error': str(e)}).encode('utf-8'))
+                log.exception("Error serving asset %s: %s", dist_file, e)
+                self.send_error(500)
                 return
-        
-        elif path.startswith('/files/buffer/'):
-            try:
-                # Extract filename from path
-                filename = path[14:]  # Remove '/files/buffer/' (14 characters)
-                filename = unquote(filename)  # Decode URL-encoded filename
-                filename = os.path.basename(filename)  # Prevent directory traversal
-                filename = ''.join(c for c in filename if c.isalnum() or c in '.-_')
-                
-                if not filename.endswith('.json'):
-                    filename += '.json'
-                
-                script_dir = os.path.dirname(os.path.abspath(__file__))
-                saved_files_dir = os.path.join(script_dir, 'saved_files')
-                buffers_dir = os.path.join(saved_files_dir, 'buffers')
-                file_path = os.path.join(buffers_dir, filename)
-                
-                if not os.path.exists(file_path):
-                    # Buffer doesn't exist yet (first time opening file) - create it with empty buffer
-                    # This prevents console errors and ensures the file exists for future loads
-                    empty_buffer = {
-                        'undoStack': [],
-                        'redoStack': [],
-                        'snapshots': [],
-                        'lastChangeIndex': 0
-                    }
-                    
-                    # Create the buffers directory if it doesn't exist
-                    os.makedirs(buffers_dir, exist_ok=True)
+            else:
+                # Serve the file with sendfile() rather than reading it into
+                # memory; once headers are out, errors just drop the connection
+                with f:
+                    etag = make_etag(st)
+                    if not self._reply_if_not_modified(etag):
+                        # Add preload hint for JS modules
+                        link = f'Link: <{path}>; rel=modulepreload\r\n' if content_type == 'application/javascript' else ''
+                        self._send_reply_headers(200, st.st_size, content_type, etag, link)
+                        self.copyfile(f, self.wfile)
+                return
+        self.send_error(404)
+    
+    def _get_file_list(self, path):
+        """GET /files"""
+        try:
+            # Saves, renames and deletes all bump the directory mtime, so the
+            # encoded listing is reused until the directory changes
+            dir_mtime = os.stat(SAVED_FILES_DIR).st_mtime_ns
+            settled = time.time_ns() - dir_mtime >= LISTING_SETTLE_NS
+            with listing_lock:
+                if settled and listing_cache['mtime'] == dir_mtime:
+                    body = listing_cache['body']
+                else:
+                    # List all JSON files (backups end in .bak and are skipped by the
+                    # name check before any stat is issued)
+                    files = []
+                    with os.scandir(SAVED_FILES_DIR) as entries:
+                        for entry in entries:
+                            if entry.name.endswith('.json') and entry.is_file():
+                                stat = entry.stat()
+                                files.append({
+                                    'filename': entry.name,
+                                    'size': stat.st_size,
+                                    'modified': stat.st_mtime
+                                })
                     
-                    # Write the empty buffer file
-                    try:
-                        with open(file_path, 'w', encoding='utf-8') as f:
-                            json.dump(empty_buffer, f, indent=2)
-                        print(f"Created new buffer file: {filename}")
-                    except Exception as e:
-                        print(f"Error creating buffer file {filename}: {e}")
-                        # Still return the empty buffer even if file creation fails
+                    # Sort by modified time (newest first)
+                    files.sort(key=operator.itemgetter('modified'), reverse=True)
                     
-                    # Return the empty buffer
-                    self.send_response(200)
-                    self.send_header('Content-type', 'application/json')
-                    self.send_header('Access-Control-Allow-Origin', '*')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({
-                        'success': True,
-                        'buffer': empty_buffer
-                    }).encode('utf-8'))
-                    return
-                
-                # Read and return buffer file
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    buffer_data = json.load(f)
-                
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'success': True, 'buffer': buffer_data}).encode('utf-8'))
+                    body = json_dumps({'success': True, 'files': files})
+                    if settled:
+                        listing_cache['mtime'] = dir_mtime
+                        listing_cache['body'] = body
+            
+            self._reply_bytes(200, body)
+            return
+            
+        except Exception as e:
+            log.exception("Error listing files: %s", e)
+            self._reply_json(500, {'success': False, 'error': str(e)})
+    
+    def _get_buffer(self, path):
+        """GET /files/buffer/<name>"""
+        try:
+            # Extract filename from path
+            filename = path[14:]  # Remove '/files/buffer/' (14 characters)
+            filename = unquote(filename)  # Decode URL-encoded filename
+            filename = normalize_filename(filename)  # Prevent directory traversal
+            
+            file_path = os.path.join(BUFFERS_DIR, filename)
+            
+            if not os.path.exists(file_path):
+                # Buffer doesn't exist yet (first time opening file) - create it with empty buffer
+                # This prevents console errors and ensures the file exists for future loads
+                empty_buffer = {
+                    'undoStack': [],
+                    'redoStack': [],
+                    'snapshots': [],
+                    'lastChangeIndex': 0
+                }
+                
+                # Write the empty buffer file
+                try:
+                    write_json_file(file_path, empty_buffer)
+                    log.info("Created new buffer file: %s", filename)
+                except Exception as e:
+                    log.error("Error creating buffer file %s: %s", filename, e)
+                    # Still return the empty buffer even if file creation fails
+                
+                # Return the empty buffer
+                self._reply_json(200, {
+                    'success': True,
+                    'buffer': empty_buffer
+                })
                 return
-                
-            except Exception as e:
-                import traceback
-                print(f"Error loading buffer file: {e}")
-                traceback.print_exc()
-                self.send_response(500)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'success': False, 'error': str(e)}).encode('utf-8'))
+            
+            st = os.stat(file_path)
+            etag = make_etag(st)
+            if self._reply_if_not_modified(etag):
                 return
-        elif path.startswith('/files/'):
-            import time
-            start_time = time.time()
-            try:
-                # Extract filename from path and URL decode it
-                filename = path[7:]  # Remove '/files/'
-                filename = unquote(filename)  # Decode URL-encoded filename
-                filename = os.path.basename(filename)  # Prevent directory traversal
-                filename = ''.join(c for c in filename if c.isalnum() or c in '.-_')
-                
-                script_dir = os.path.dirname(os.path.abspath(__file__))
-                
-                # Handle .tex files from _test/latex/ directory
-                if filename.endswith('.tex'):
-                    test_latex_dir = os.path.join(script_dir, '_test', 'latex')
-                    file_path = os.path.join(test_latex_dir, filename)
-                    
-                    if os.path.exists(file_path):
-                        # Serve .tex file as plain text
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            content = f.read()
-                        
-                        self.send_response(200)
-                        self.send_header('Content-type', 'text/plain; charset=utf-8')
-                        self.send_header('Access-Control-Allow-Origin', '*')
-                        self.send_header('Content-Length', str(len(content.encode('utf-8'))))
-                        self.end_headers()
-                        self.wfile.write(content.encode('utf-8'))
-                        return
-                    else:
-                        self.send_response(404)
-                        self.send_header('Content-type', 'text/plain')
-                        self.send_header('Access-Control-Allow-Origin', '*')
-                        self.end_headers()
-                        self.wfile.write(b'File not found')
-                        return
-                
-                # Accept both .json and .bak files
-                if not filename.endswith('.json') and not filename.endswith('.bak'):
-                    filename += '.json'
-                
-                saved_files_dir = os.path.join(script_dir, 'saved_files')
-                file_path = os.path.join(saved_files_dir, filename)
-                
-                if not os.path.exists(file_path):
-                    self.send_response(404)
-                    self.send_header('Content-type', 'application/json')
-                    self.send_header('Access-Control-Allow-Origin', '*')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({'success': False, 'error': 'File not found'}).encode('utf-8'))
+            
+            # The buffer file is already JSON, so it is passed through untouched
+            self._reply_wrapped_file(b'{"success":true,"buffer":', file_path, b'}', st, etag=etag)
+            return
+            
+        except Exception as e:
+            log.exception("Error loading buffer file: %s", e)
+            self._reply_json(500, {'success': False, 'error': str(e)})
+    
+    def _get_file(self, path):
+        """GET /files/<name>"""
+        if PERF:
+            start_time = time.perf_counter_ns()
+        try:
+            # Extract filename from path and URL decode it
+            filename = path[7:]  # Remove '/files/'
+            filename = unquote(filename)  # Decode URL-encoded filename
+            filename = sanitize_filename(filename)  # Prevent directory traversal
+            
+            # Handle .tex files from _test/latex/ directory
+            if filename.endswith('.tex'):
+                file_path = os.path.join(TEST_LATEX_DIR, filename)
+                
+                try:
+                    f = open(file_path, 'rb')
+                except FileNotFoundError:
+                    self._reply_bytes(404, b'File not found', 'text/plain')
                     return
                 
-                # Read and return file - optimize by reading file size first
-                read_start = time.time()
-                file_size = os.path.getsize(file_path)
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    file_data = json.load(f)
-                read_time = time.time() - read_start
-                
-                # Serialize JSON once - use separators to reduce size
-                serialize_start = time.time()
-                response_data = json.dumps({'success': True, 'data': file_data, 'filename': filename}, ensure_ascii=False, separators=(',', ':'))
-                response_bytes = response_data.encode('utf-8')
-                serialize_time = time.time() - serialize_start
-                
-                # Send response - minimize headers for speed
-                send_start = time.time()
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.send_header('Content-Length', str(len(response_bytes)))
-                self.end_headers()
-                self.wfile.write(response_bytes)
-                self.wfile.flush()
-                send_time = time.time() - send_start
-                total_time = time.time() - start_time
-                
-                # Log to stderr (captured in log file when running in background)
-                import sys
-                perf_msg = f"[PERF] {filename}: read={read_time*1000:.1f}ms, serialize={serialize_time*1000:.1f}ms, send={send_time*1000:.1f}ms, total={total_time*1000:.1f}ms, {len(response_bytes)}B\n"
-                sys.stderr.write(perf_msg)
-                sys.stderr.flush()
+                # Serve .tex file as plain text, straight from disk with sendfile()
+                with f:
+                    self._send_reply_headers(200, os.fstat(f.fileno()).st_size, 'text/plain; charset=utf-8', None)
+                    self.copyfile(f, self.wfile)
                 return
-                
-            except Exception as e:
-                import traceback
-                print(f"Error loading file: {e}")
-                traceback.print_exc()
-                self.send_response(500)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'success': False, 'error': str(e)}).encode('utf-8'))
+            
+            # Accept both .json and .bak files
+            if not filename.endswith('.json') and not filename.endswith('.bak'):
+                filename += '.json'
+            
+            file_path = os.path.join(SAVED_FILES_DIR, filename)
+            
+            try:
+                st = os.stat(file_path)
+            except FileNotFoundError:
+                self._reply_bytes(404, self.FILE_NOT_FOUND_BODY)
                 return
-        
-        # Store the original path
-        self.request_path = self.path
-        
-        # Add cache-busting query parameter handling for default.json
-        if self.path.startswith('/default.json'):
-            # Remove query parameters for file lookup
-            parsed_path = urlparse(self.path)
-            self.path = parsed_path.path
             
-        return super().do_GET()
+            etag = make_etag(st)
+            if self._reply_if_not_modified(etag):
+                return
+            
+            # The saved file is already JSON: wrap it in the response envelope
+            # as-is rather than parsing and re-encoding it
+            send_start = time.perf_counter_ns() if PERF else 0
+            size = self._reply_wrapped_file(b'{"success":true,"data":', file_path, b',"filename":' + json_dumps(filename) + b'}', st, etag=etag)
+            if not PERF:
+                return
+            
+            self.wfile.flush()
+            end_time = time.perf_counter_ns()
+            log.info("[PERF] %s: send=%.1fms, total=%.1fms, %dB", filename, (end_time - send_start) / 1e6, (end_time - start_time) / 1e6, size)
+            return
+            
+        except Exception as e:
+            log.exception("Error loading file: %s", e)
+            self._reply_json(500, {'success': False, 'error': str(e)})
+    
+    _GET_ROUTES = {
+        '/favicon.ico': _get_favicon,
+        '/': _get_index,
+        '/index.html': _get_index,
+        '/files': _get_file_list,
+    }
+    # Probed in order, so longer prefixes come first
+    _GET_PREFIX_ROUTES = (
+        ('/assets/', _get_asset),
+        ('/files/buffer/', _get_buffer),
+        ('/files/', _get_file),
+    )
     
     def end_headers(self):
         """Add CORS headers and cache control to all responses"""
-        # Add HTTP/2-like optimizations for module loading
-        # Set higher connection limit hint (though browser may ignore)
-        if self.path.endswith('.js'):
-            # Add preload hint for JS modules
-            self.send_header('Link', f'<{self.path}>; rel=modulepreload')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Content-Length')
-        
-        # Add no-cache headers for HTML, CSS, and JS files to prevent caching
-        path = self.request_path or self.path
-        # Parse path to get clean path without query params
-        parsed_path = urlparse(path)
-        clean_path = parsed_path.path
-        
-        # Debug: log the path being processed
-        print(f"[DEBUG] end_headers called with path={path}, clean_path={clean_path}")
-        
-        if clean_path.endswith(('.html', '.css', '.js', '.json')) or clean_path == '/' or clean_path == '/index.html' or clean_path == '':
-            self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-            self.send_header('Pragma', 'no-cache')
-            self.send_header('Expires', '0')
-        
-        # Add CSP header for HTML files to allow data URIs for scripts and WebSocket connections
-        # This is critical for modulepreload links that may be converted to data URIs
-        is_html_path = clean_path.endswith('.html') or clean_path == '/' or clean_path == '/index.html' or clean_path == ''
-        print(f"[DEBUG] is_html_path={is_html_path} for clean_path={clean_path}")
-        
-        if is_html_path:
-            # Allow data URIs for scripts (needed for some module loading scenarios)
-            # script-src-elem is specifically for <script> elements and takes precedence
-            # Using both script-src and script-src-elem to ensure coverage
-            # connect-src allows WebSocket connections (ws:// and wss://)
-            csp_policy = "default-src 'self' 'unsafe-inline' 'unsafe-eval' https://cdn.jsdelivr.net data: blob: ws: wss: http://localhost:*; connect-src 'self' ws: wss: http://localhost:* https://cdn.jsdelivr.net; script-src 'self' 'unsafe-inline' 'unsafe-eval' https://cdn.jsdelivr.net data: blob:; script-src-elem 'self' 'unsafe-inline' 'unsafe-eval' https://cdn.jsdelivr.net data: blob:; style-src 'self' 'unsafe-inline';"
-            self.send_header('Content-Security-Policy', csp_policy)
-            # Debug: print to verify CSP is being set
-            print(f"[CSP] Setting CSP header for {clean_path} with connect-src")
-        else:
-            print(f"[DEBUG] NOT setting CSP header - path doesn't match HTML condition")
-        
+        if self.request_version != 'HTTP/0.9':
+            # One pre-encoded block instead of a send_header() call per line
+            self._headers_buffer.append(policy_header_block(self._url_path()))
         super().end_headers()
     
     def do_OPTIONS(self):
         """Handle OPTIONS requests for CORS preflight"""
-        print(f"OPTIONS request received: path={self.path}")
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Content-Length')
-        self.send_header('Access-Control-Max-Age', '86400')
-        self.end_headers()
+        log.debug("OPTIONS request received: path=%s", self.path)
+        self._reply_canned(204, self.OPTIONS_RESPONSE)
     
     def do_PUT(self):
         """Handle PUT requests for file rename"""
-        parsed_path = urlparse(self.path)
-        path = parsed_path.path
+        path = self._url_path()
         
         if path.startswith('/files/') and path.endswith('/rename'):
             try:
                 # Extract filename from path
                 filename = path[7:-7]  # Remove '/files/' and '/rename'
-                filename = os.path.basename(filename)
-                filename = ''.join(c for c in filename if c.isalnum() or c in '.-_')
-                if not filename.endswith('.json'):
-                    filename += '.json'
+                filename = normalize_filename(filename)
                 
-                script_dir = os.path.dirname(os.path.abspath(__file__))
-                saved_files_dir = os.path.join(script_dir, 'saved_files')
-                old_file_path = os.path.join(saved_files_dir, filename)
+                old_file_path = os.path.join(SAVED_FILES_DIR, filename)
                 
                 if not os.path.exists(old_file_path):
-                    self.send_response(404)
-                    self.send_header('Content-type', 'application/json')
-                    self.send_header('Access-Control-Allow-Origin', '*')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({'success': False, 'error': 'File not found'}).encode('utf-8'))
+                    self._reply_bytes(404, self.FILE_NOT_FOUND_BODY)
                     return
                 
                 # Read new filename from body
-                content_length = int(self.headers.get('Content-Length', 0))
+                content_length = self._content_length()
+                if content_length is None:
+                    return
                 if content_length == 0:
                     raise ValueError("No content length specified")
                 
-                put_data = self.rfile.read(content_length)
-                data = json.loads(put_data.decode('utf-8'))
+                put_data = self._read_body(content_length)
+                data = json_loads(put_data)
                 new_filename = data.get('filename', '')
                 
                 if not new_filename:
                     raise ValueError("New filename is required")
                 
                 # Sanitize new filename
-                new_filename = os.path.basename(new_filename)
-                new_filename = ''.join(c for c in new_filename if c.isalnum() or c in '.-_')
-                if not new_filename.endswith('.json'):
-                    new_filename += '.json'
+                new_filename = normalize_filename(new_filename)
                 
-                new_file_path = os.path.join(saved_files_dir, new_filename)
+                new_file_path = os.path.join(SAVED_FILES_DIR, new_filename)
                 
                 # Check if new filename already exists
                 if os.path.exists(new_file_path) and new_filename != filename:
-                    self.send_response(409)
-                    self.send_header('Content-type', 'application/json')
-                    self.send_header('Access-Control-Allow-Origin', '*')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({'success': False, 'error': 'File already exists'}).encode('utf-8'))
+                    self._reply_bytes(409, self.FILE_EXISTS_BODY)
                     return
                 
                 # Rename file
                 os.rename(old_file_path, new_file_path)
                 
-                print(f"File renamed: {filename} -> {new_filename}")
+                log.info("File renamed: %s -> %s", filename, new_filename)
                 
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'success': True, 'message': f'File renamed to {new_filename}', 'filename': new_filename}).encode('utf-8'))
+                self._reply_json(200, {'success': True, 'message': f'File renamed to {new_filename}', 'filename': new_filename})
                 return
                 
             except Exception as e:
-                import traceback
-                print(f"Error renaming file: {e}")
-                traceback.print_exc()
-                self.send_response(500)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'success': False, 'error': str(e)}).encode('utf-8'))
+                log.exception("Error renaming file: %s", e)
+                self._reply_json(500, {'success': False, 'error': str(e)})
                 return
         else:
-            self.send_response(405)
-            self.send_header('Allow', 'GET, POST, PUT, DELETE, OPTIONS')
-            self.end_headers()
+            self._reply_not_allowed()
     
     def do_DELETE(self):
         """Handle DELETE requests for file deletion"""
-        parsed_path = urlparse(self.path)
-        path = parsed_path.path
+        path = self._url_path()
         
         if path.startswith('/files/'):
             try:
                 # Extract filename from path
                 filename = path[7:]  # Remove '/files/'
                 filename = unquote(filename)  # Decode URL-encoded filename
-                filename = os.path.basename(filename)
-                filename = ''.join(c for c in filename if c.isalnum() or c in '.-_')
                 # Accept both .json and .bak files
-                if not filename.endswith('.json') and not filename.endswith('.bak'):
-                    filename += '.json'
+                filename = normalize_filename(filename, allow_bak=True)  # Prevent directory traversal
                 
-                script_dir = os.path.dirname(os.path.abspath(__file__))
-                saved_files_dir = os.path.join(script_dir, 'saved_files')
-                file_path = os.path.join(saved_files_dir, filename)
+                file_path = os.path.join(SAVED_FILES_DIR, filename)
                 
-                if not os.path.exists(file_path):
-                    self.send_response(404)
-                    self.send_header('Content-type', 'application/json')
-                    self.send_header('Access-Control-Allow-Origin', '*')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({'success': False, 'error': 'File not found'}).encode('utf-8'))
+                # Delete file; a missing file is reported by remove() itself
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    self._reply_bytes(404, self.FILE_NOT_FOUND_BODY)
                     return
                 
-                # Delete file
-                os.remove(file_path)
+                log.info("File deleted: %s", filename)
                 
-                print(f"File deleted: {filename}")
-                
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'success': True, 'message': f'File {filename} deleted'}).encode('utf-8'))
+                self._reply_json(200, {'success': True, 'message': f'File {filename} deleted'})
                 return
                 
             except Exception as e:
-                import traceback
-                print(f"Error deleting file: {e}")
-                traceback.print_exc()
-                self.send_response(500)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'success': False, 'error': str(e)}).encode('utf-8'))
+                log.exception("Error deleting file: %s", e)
+                self._reply_json(500, {'success': False, 'error': str(e)})
                 return
         else:
-            self.send_response(405)
-            self.send_header('Allow', 'GET, POST, PUT, DELETE, OPTIONS')
-            self.end_headers()
+            self._reply_not_allowed()
 
-def main():
-    """Start the server"""
-    # Change to the directory where this script is located
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    os.chdir(script_dir)
+# Tailscale hands out addresses from the carrier-grade NAT range
+TAILSCALE_NETWORK = ipaddress.ip_network('100.64.0.0/10')
+SIOCGIFADDR = 0x8915
+# 'tailscale ip' answers from the local daemon in well under this when it is healthy
+TAILSCALE_TIMEOUT = 0.5
+
+def interface_addresses():
+    """Return the IPv4 address of each configured interface, or None where this isn't supported
     
-    # Use ThreadingHTTPServer for concurrent request handling
-    # This prevents blocking when multiple requests come in (e.g., plugin files)
-    with ThreadingHTTPServer(("0.0.0.0", PORT), TwodoHandler) as httpd:
-        print(f"Starting server on http://localhost:{PORT}")
-        print(f"Using TwodoHandler - POST endpoint: /save-default.json")
-        
-        # Get local IP for LAN access
-        import socket
-        local_ips = []
-        tailscale_ip = None
-        
-        try:
-            # Try to get a better IP (not localhost) by connecting to external address
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    Uses the SIOCGIFADDR ioctl, so it only runs on Linux; elsewhere the caller falls
+    back to probing routes and asking the tailscale CLI.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    import fcntl
+    addresses = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        for _, name in socket.if_nameindex():
+            try:
+                ifreq = fcntl.ioctl(s.fileno(), SIOCGIFADDR, struct.pack('256s', name.encode()[:15]))
+            except OSError:
+                # Interface is down or has no IPv4 address
+                continue
+            addresses.append(ipaddress.IPv4Address(ifreq[20:24]))
+    return addresses
+
+def discover_addresses():
+    """Return (local_ips, tailscale_ip) for this machine"""
+    try:
+        addresses = interface_addresses()
+    except OSError:
+        addresses = None
+    if addresses is not None:
+        # One pass over the interfaces covers both LAN and Tailscale addresses
+        local_ips = [str(a) for a in addresses if not (a.is_loopback or a.is_link_local or a in TAILSCALE_NETWORK)]
+        tailscale_ips = [str(a) for a in addresses if a in TAILSCALE_NETWORK]
+        return local_ips, tailscale_ips[0] if tailscale_ips else None
+    
+    local_ips = []
+    tailscale_ip = None
+    
+    # Start the tailscale CLI first so it runs while the LAN probes below do
+    try:
+        import subprocess
+        tailscale = subprocess.Popen(['tailscale', 'ip'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    except OSError:
+        tailscale = None
+    
+    try:
+        # Find the address of the default route. Connecting a UDP socket sends no
+        # packets, and the numeric address never touches the resolver
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
             s.connect(("8.8.8.8", 80))
             local_ip = s.getsockname()[0]
-            s.close()
-            if local_ip and local_ip != '127.0.0.1':
-                local_ips.append(local_ip)
-        except Exception:
-            pass
-        
-        # Fallback: try hostname
+        if local_ip and local_ip != '127.0.0.1':
+            local_ips.append(local_ip)
+    except Exception:
+        pass
+    
+    # Fallback: try hostname. This can block on DNS, so it only runs when there
+    # is no default route to learn the address from
+    if not local_ips:
         try:
             hostname = socket.gethostname()
             host_ip = socket.gethostbyname(hostname)
-            if host_ip and host_ip != '127.0.0.1' and host_ip not in local_ips:
+            if host_ip and not host_ip.startswith('127.'):
                 local_ips.append(host_ip)
         except Exception:
             pass
-        
-        # Check for Tailscale IP (typically 100.x.x.x)
+    
+    # Check for Tailscale IP (typically 100.x.x.x)
+    if tailscale is not None:
         try:
-            import subprocess
-            result = subprocess.run(['tailscale', 'ip'], capture_output=True, text=True, timeout=2)
-            if result.returncode == 0:
-                tailscale_ip = result.stdout.strip().split('\n')[0]
-                if tailscale_ip and tailscale_ip.startswith('100.'):
-                    print(f"Accessible via Tailscale at http://{tailscale_ip}:{PORT}")
+            stdout, _ = tailscale.communicate(timeout=TAILSCALE_TIMEOUT)
+            if tailscale.returncode == 0:
+                tailscale_ip = stdout.strip().split('\n')[0]
+                if not tailscale_ip.startswith('100.'):
+                    tailscale_ip = None
+        except subprocess.TimeoutExpired:
+            # A hung daemon shouldn't leave the CLI behind
+            tailscale.kill()
+            tailscale.wait()
+            tailscale.stdout.close()
         except Exception:
             pass
-        
-        # Print LAN IPs
-        for ip in local_ips:
-            print(f"Accessible on LAN at http://{ip}:{PORT}")
-        
-        if not tailscale_ip and not local_ips:
-            print("Note: To access from remote devices, use Tailscale VPN or set up port forwarding")
-        
-        print("Press Ctrl+C to stop")
+    
+    return local_ips, tailscale_ip
+
+def load_address_cache():
+    """Return the cached (local_ips, tailscale_ip), or None if missing or stale"""
+    try:
+        with open(ADDRESS_CACHE_PATH, 'rb') as f:
+            cached = json_loads(f.read())
+        if 0 <= time.time() - cached['ts'] < ADDRESS_CACHE_TTL:
+            return cached['local_ips'], cached['tailscale_ip']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def print_access_urls(port):
+    """Print the LAN and Tailscale URLs the server can be reached on
+    
+    Runs on a background thread: the DNS lookup and the tailscale subprocess can
+    take seconds, and the listener is already accepting connections meanwhile.
+    Results are cached on disk for ADDRESS_CACHE_TTL seconds so quick restarts
+    skip discovery entirely.
+    """
+    cached = load_address_cache()
+    if cached is not None:
+        local_ips, tailscale_ip = cached
+    else:
+        local_ips, tailscale_ip = discover_addresses()
+        try:
+            write_json_file(ADDRESS_CACHE_PATH, {
+                'local_ips': local_ips,
+                'tailscale_ip': tailscale_ip,
+                'ts': time.time()
+            }, fsync=False)
+        except OSError:
+            pass
+    
+    if tailscale_ip:
+        print(f"Accessible via Tailscale at http://{tailscale_ip}:{port}")
+    
+    # Print LAN IPs
+    for ip in local_ips:
+        print(f"Accessible on LAN at http://{ip}:{port}")
+    
+    if not tailscale_ip and not local_ips:
+        print("Note: To access from remote devices, use Tailscale VPN or set up port forwarding")
+
+def fork_workers(count):
+    """Fork count - 1 extra server processes that share the port through SO_REUSEPORT
+    
+    Each process binds its own listening socket and the kernel spreads incoming
+    connections across them. Returns the child pids in the parent and None in a
+    child. Platforms without fork() or SO_REUSEPORT run a single process.
+    """
+    if count <= 1:
+        return []
+    if not (hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')):
+        print("--workers needs fork() and SO_REUSEPORT; running a single process")
+        return []
+    TwodoServer.reuse_port = True
+    # Children hold the read end of this pipe; it hits EOF when the parent exits
+    # for any reason, so a killed parent never leaves orphaned servers behind
+    parent_alive, parent_handle = os.pipe()
+    children = []
+    for _ in range(count - 1):
+        pid = os.fork()
+        if pid == 0:
+            os.close(parent_handle)
+            threading.Thread(target=exit_with_parent, args=(parent_alive,), name='twodo-parent-watch', daemon=True).start()
+            return None
+        children.append(pid)
+    os.close(parent_alive)
+    return children
+
+def exit_with_parent(fd):
+    """Block until the parent process exits, then stop this one as if interrupted"""
+    os.read(fd, 1)
+    _thread.interrupt_main()
+
+def start_log_listener():
+    """Hand log output to a background thread
+    
+    Request threads only put records on a queue and the listener thread does the
+    writes, so a slow terminal or log pipe never holds up a response. Returns the
+    listener, which must be stopped on exit to flush what is still queued.
+    """
+    root = logging.getLogger()
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *root.handlers)
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    listener.start()
+    return listener
+
+def main():
+    """Start the server"""
+    # Request lines and saves at INFO; --verbose adds per-request debug detail
+    if '--verbose' in sys.argv:
+        level = logging.DEBUG
+    elif '--quiet' in sys.argv:
+        level = logging.WARNING
+    else:
+        level = logging.INFO
+    logging.basicConfig(level=level, format='%(message)s')
+    log.addFilter(RepeatedErrorFilter())
+    
+    # Change to the directory where this script is located
+    os.chdir(SCRIPT_DIR)
+    
+    # Create the data directories once instead of on every request
+    for directory in (SAVED_FILES_DIR, BUFFERS_DIR, AUDIO_DIR):
+        os.makedirs(directory, exist_ok=True)
+    
+    children = fork_workers(WORKERS)
+    is_parent = children is not None
+    # Started after forking: the listener thread would not exist in the children
+    log_listener = start_log_listener()
+    
+    threading.Thread(target=fsync_worker, name='twodo-fsync', daemon=True).start()
+    
+    # Use a pooled ThreadingHTTPServer for concurrent request handling
+    # This prevents blocking when multiple requests come in (e.g., plugin files)
+    with TwodoServer(("0.0.0.0", PORT), TwodoHandler) as httpd:
+        if is_parent:
+            print(f"Starting server on http://localhost:{PORT}")
+            print(f"Using TwodoHandler - POST endpoint: /save-default.json")
+            if children:
+                print(f"Serving from {len(children) + 1} processes")
+            
+            threading.Thread(target=print_access_urls, args=(PORT,), name='twodo-discovery', daemon=True).start()
+            
+            print("Press Ctrl+C to stop")
+        # docker stop / systemctl stop send SIGTERM: leave serve_forever() the
+        # same way Ctrl+C does so the finally block still closes everything.
+        # shutdown() blocks until serve_forever() returns, so it can't be
+        # called from the handler, which runs on the serving thread
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=httpd.shutdown, daemon=True).start())
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
-            print("\nServer stopped.")
-        except Exception as e:
-            print(f"\nServer error: {e}")
-            import traceback
-            traceback.print_exc()
+            if is_parent:
+                print("\nServer stopped.")
+        except Exception:
+            log.exception("Server error")
         finally:
             # Ensure server is properly shut down
             httpd.shutdown()
             httpd.server_close()
+            for pid in children or ():
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                    os.waitpid(pid, 0)
+                except (ProcessLookupError, ChildProcessError):
+                    pass
+            log_listener.stop()
 
 if __name__ == "__main__":
     main()
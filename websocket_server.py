@@ -4,37 +4,171 @@ WebSocket server for real-time synchronization and undo/redo support
 """
 import asyncio
 import websockets
+from websockets.version import version as websockets_version
 import json
 import os
+import signal
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque
+from itertools import count, islice
 import threading
+import time
+
+# orjson is optional; fall back to the stdlib encoder when it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# uvloop is optional too; the stock asyncio loop is used without it (e.g. on Windows)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+if orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps(obj, indent=False):
+        """Serialize obj to UTF-8 JSON bytes, pretty-printed with two spaces when indent is set"""
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj, indent=False):
+        """Serialize obj to UTF-8 JSON bytes, pretty-printed with two spaces when indent is set"""
+        if indent:
+            return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+# Changes kept per file for undo/redo; older ones drop off the front
+CHANGE_HISTORY_LIMIT = 1000
+# Operations kept per file for catch-up on join
+OPERATION_LOG_LIMIT = 5000
+# Seconds to wait after an edit before writing the file, so bursts share one write
+SAVE_DELAY = 0.25
+# Frames buffered per client before it is treated as too slow and disconnected
+SEND_QUEUE_SIZE = 256
+# send() takes text= from websockets 14.0 on; older versions need a str for a text frame
+SEND_BYTES_AS_TEXT = int(websockets_version.split('.')[0]) >= 14
+
+def read_json_file(file_path):
+    """Read and parse a JSON file; run through asyncio.to_thread"""
+    with open(file_path, 'rb') as f:
+        return json_loads(f.read())
+
+# Windows refuses to rename over a file another handle has open (server.py
+# serving it, for one); such handles are short-lived, so retry
+REPLACE_RETRY_DELAYS = (0.01, 0.02, 0.05, 0.1, 0.2)
+
+def write_file(file_path, body):
+    """Atomically replace file_path with body; run through asyncio.to_thread
+    
+    The bytes go to a temp file next to file_path and are renamed over it, so a
+    crash or a concurrent reader (server.py serves the same files) never sees a
+    half-written document. No fsync: the state is rebroadcast and saved again
+    on the next edit anyway.
+    """
+    tmp_path = f'{file_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        if os.name == 'nt':
+            for delay in REPLACE_RETRY_DELAYS:
+                try:
+                    os.replace(tmp_path, file_path)
+                    return
+                except PermissionError:
+                    time.sleep(delay)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def now_ms():
+    """Milliseconds since the epoch, like JavaScript's Date.now()"""
+    return time.time_ns() // 1_000_000
+
+def navigate(root, path, create=False):
+    """Follow path[:-1] from root and return the container path[-1] refers into
+    
+    Tries plain indexing first and only falls back to int() for list keys that
+    arrive as strings. Returns None when a step is missing, out of range or
+    lands on a non-container. With create set, missing dict keys are filled
+    in with a list or dict depending on whether the following key is numeric.
+    """
+    target = root
+    for i in range(len(path) - 1):
+        key = path[i]
+        try:
+            child = target[key]
+        except KeyError:
+            if not create or not isinstance(target, dict):
+                return None
+            next_key = path[i + 1]
+            child = target[key] = [] if isinstance(next_key, int) or (isinstance(next_key, str) and next_key.isdigit()) else {}
+        except TypeError:
+            # Lists are addressed with numeric strings as well as ints
+            if not isinstance(target, list):
+                return None
+            try:
+                idx = int(key)
+            except (ValueError, TypeError):
+                return None
+            if not 0 <= idx < len(target):
+                return None
+            child = target[idx]
+        except IndexError:
+            return None
+        else:
+            # Negative ints would index from the end; paths never mean that
+            if isinstance(key, int) and key < 0 and isinstance(target, list):
+                return None
+        target = child
+    return target
+
+def tail(items, n):
+    """Return the last n items of a deque as a list"""
+    return list(islice(items, max(0, len(items) - n), None))
 
 class SyncServer:
     def __init__(self, port=8001):
         self.port = port
+        # Resolved and created once; load/save only join the filename onto it
+        self.saved_files_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'saved_files')
+        os.makedirs(self.saved_files_dir, exist_ok=True)
         self.clients = {}  # {client_id: websocket}
+        self.send_queues = {}  # {client_id: queue of encoded frames}
+        self.client_writers = {}  # {client_id: task draining the send queue}
         self.file_sessions = defaultdict(dict)  # {filename: {client_id: session_info}}
-        self.change_history = defaultdict(list)  # {filename: [changes]}
+        self.change_history = defaultdict(lambda: deque(maxlen=CHANGE_HISTORY_LIMIT))  # {filename: deque of changes}
+        self.change_index = defaultdict(dict)  # {filename: {changeId: change}} for the changes in history
+        self.undo_stacks = defaultdict(deque)  # {(filename, client_id): that client's changes still in history and not undone}
         self.file_data = {}  # {filename: current_data}
         self.client_files = defaultdict(set)  # {client_id: {filenames}}
-        self.operation_logs = defaultdict(list)  # {filename: [operations]}
+        self.operation_logs = defaultdict(lambda: deque(maxlen=OPERATION_LOG_LIMIT))  # {filename: deque of operations}
         self.operation_sequences = defaultdict(int)  # {filename: last_sequence}
+        # Change ids count up from the start time in ms, so ids stay unique across restarts
+        self.change_ids = count(now_ms())
+        self.save_tasks = {}  # {filename: pending delayed save task}
+        self.save_locks = defaultdict(asyncio.Lock)  # {filename: lock held while writing}
+        self.close_tasks = set()  # closes of clients dropped for a full send queue, held until done
         
     async def register_client(self, websocket, path=None):
         """Register a new client connection"""
         client_id = f"client_{id(websocket)}"
         self.clients[client_id] = websocket
+        self.send_queues[client_id] = queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.client_writers[client_id] = asyncio.create_task(self.client_writer(client_id, websocket, queue))
         # Try to get path from websocket object if not provided
         if path is None:
             path = getattr(websocket, 'path', None) or getattr(websocket, 'request_path', None)
         print(f"Client connected: {client_id} (path: {path})")
         
         try:
-            await websocket.send(json.dumps({
-                'type': 'connected',
-                'clientId': client_id
-            }))
+            # client_id is "client_" plus digits, so it needs no JSON escaping
+            self.send_payload(client_id, b'{"type":"connected","clientId":"%s"}' % client_id.encode('ascii'))
             
             async for message in websocket:
                 await self.handle_message(client_id, message)
@@ -51,22 +185,25 @@ class SyncServer:
         """Unregister a client and clean up their sessions"""
         if client_id in self.clients:
             del self.clients[client_id]
+        self.send_queues.pop(client_id, None)
+        writer = self.client_writers.pop(client_id, None)
+        if writer is not None:
+            writer.cancel()
         
         # Remove client from all file sessions
-        for filename in list(self.client_files[client_id]):
+        for filename in self.client_files.pop(client_id, ()):
             if filename in self.file_sessions:
                 if client_id in self.file_sessions[filename]:
                     del self.file_sessions[filename][client_id]
                 if not self.file_sessions[filename]:
                     del self.file_sessions[filename]
         
-        del self.client_files[client_id]
         print(f"Client disconnected: {client_id}")
     
     async def handle_message(self, client_id, message):
         """Handle incoming WebSocket messages"""
         try:
-            data = json.loads(message)
+            data = json_loads(message)
             msg_type = data.get('type')
             
             if msg_type == 'join_file':
@@ -87,7 +224,7 @@ class SyncServer:
                 await self.handle_operation_sync(client_id, data)
             elif msg_type == 'request_operations':
                 await self.handle_request_operations(client_id, data)
-        except json.JSONDecodeError:
+        except ValueError:
             print(f"Invalid JSON from {client_id}")
         except Exception as e:
             print(f"Error handling message from {client_id}: {e}")
@@ -99,9 +236,6 @@ class SyncServer:
             return
         
         # Add client to file session
-        if filename not in self.file_sessions:
-            self.file_sessions[filename] = {}
-        
         self.file_sessions[filename][client_id] = {
             'joined': datetime.now().isoformat(),
             'cursor': data.get('cursor')
@@ -114,7 +248,7 @@ class SyncServer:
         
         # Get timestamp from file data or use current time
         file_data = self.file_data.get(filename, {})
-        file_timestamp = file_data.get('_lastSyncTimestamp', datetime.now().timestamp() * 1000)
+        file_timestamp = file_data.get('_lastSyncTimestamp', now_ms())
         
         # Send current file state to client
         await self.send_to_client(client_id, {
@@ -122,21 +256,21 @@ class SyncServer:
             'filename': filename,
             'data': file_data,
             'timestamp': file_timestamp,
-            'history': self.change_history.get(filename, [])[-50:],  # Last 50 changes
+            'history': tail(self.change_history.get(filename, ()), 50),  # Last 50 changes
             'lastOperationSequence': self.operation_sequences.get(filename, 0)  # Include last operation sequence
         })
         
-        # If operation log exists, send recent operations for catch-up
-        if filename in self.operation_logs and len(self.operation_logs[filename]) > 0:
+        # If operation log exists, send recent operations for catch-up.
+        # Reads go through .get so a join does not create empty defaultdict entries
+        operations = self.operation_logs.get(filename)
+        if operations:
             # Send last 100 operations (or all if less than 100)
-            recent_operations = self.operation_logs[filename][-100:]
-            if recent_operations:
-                await self.send_to_client(client_id, {
-                    'type': 'operations_response',
-                    'filename': filename,
-                    'operations': recent_operations,
-                    'lastSequence': self.operation_sequences[filename]
-                })
+            await self.send_to_client(client_id, {
+                'type': 'operations_response',
+                'filename': filename,
+                'operations': tail(operations, 100),
+                'lastSequence': self.operation_sequences.get(filename, 0)
+            })
         
         # Notify other clients
         await self.broadcast_to_file(filename, client_id, {
@@ -154,8 +288,9 @@ class SyncServer:
             if not self.file_sessions[filename]:
                 del self.file_sessions[filename]
         
-        if filename in self.client_files[client_id]:
-            self.client_files[client_id].remove(filename)
+        client_files = self.client_files.get(client_id)
+        if client_files is not None:
+            client_files.discard(filename)
         
         # Notify other clients
         await self.broadcast_to_file(filename, client_id, {
@@ -168,7 +303,7 @@ class SyncServer:
         """Handle full data sync from a client"""
         filename = data.get('filename')
         sync_data = data.get('data')
-        timestamp = data.get('timestamp', datetime.now().timestamp() * 1000)  # Use provided timestamp or current time
+        timestamp = data.get('timestamp', now_ms())  # Use provided timestamp or current time
         
         if not filename or not sync_data:
             return
@@ -192,8 +327,8 @@ class SyncServer:
             'clientId': client_id  # Include client ID so receivers can ignore their own messages
         })
         
-        # Save file to disk
-        await self.save_file_data(filename)
+        # Save file to disk once the burst of edits settles
+        self.schedule_save(filename)
     
     async def handle_change(self, client_id, data):
         """Handle a change from a client"""
@@ -206,19 +341,37 @@ class SyncServer:
         # Add timestamp and client ID to change
         change['timestamp'] = datetime.now().isoformat()
         change['clientId'] = client_id
-        change['changeId'] = f"{client_id}_{datetime.now().timestamp()}"
+        change['changeId'] = f"{client_id}_{next(self.change_ids)}"
         
         # Apply change to file data
         await self.apply_change(filename, change)
         
-        # Add to history
-        if filename not in self.change_history:
-            self.change_history[filename] = []
-        self.change_history[filename].append(change)
-        
-        # Keep only last 1000 changes per file
-        if len(self.change_history[filename]) > 1000:
-            self.change_history[filename] = self.change_history[filename][-1000:]
+        # Add to history; the deque drops the oldest change past the limit, and
+        # that change has to leave its author's undo stack as well
+        history = self.change_history[filename]
+        index = self.change_index[filename]
+        if len(history) == history.maxlen:
+            oldest = history[0]
+            index.pop(oldest['changeId'], None)
+            key = (filename, oldest['clientId'])
+            stack = self.undo_stacks.get(key)
+            # Undone changes are already off their stack; anything else must be
+            # removed so it cannot be undone after leaving history
+            if stack and not oldest.get('undone'):
+                if stack[0] is oldest:
+                    stack.popleft()
+                else:
+                    # Redo pushes changes back on top, out of history order;
+                    # match by identity since equal-looking changes may differ
+                    for i, entry in enumerate(stack):
+                        if entry is oldest:
+                            del stack[i]
+                            break
+                if not stack:
+                    del self.undo_stacks[key]
+        history.append(change)
+        index[change['changeId']] = change
+        self.undo_stacks[(filename, client_id)].append(change)
         
         # Broadcast to all other clients in this file
         await self.broadcast_to_file(filename, client_id, {
@@ -227,8 +380,8 @@ class SyncServer:
             'change': change
         })
         
-        # Save file to disk
-        await self.save_file_data(filename)
+        # Save file to disk once the burst of edits settles
+        self.schedule_save(filename)
     
     async def handle_undo(self, client_id, data):
         """Handle undo request"""
@@ -236,30 +389,30 @@ class SyncServer:
         if not filename or filename not in self.change_history:
             return
         
-        history = self.change_history[filename]
-        if not history:
+        # Last change by this client that is not undone yet
+        key = (filename, client_id)
+        stack = self.undo_stacks.get(key)
+        if not stack:
             return
+        change = stack.pop()
+        if not stack:
+            del self.undo_stacks[key]
+        
+        # Mark as undone
+        change['undone'] = True
+        change['undoneAt'] = datetime.now().isoformat()
         
-        # Find last change by this client
-        for i in range(len(history) - 1, -1, -1):
-            change = history[i]
-            if change.get('clientId') == client_id and not change.get('undone'):
-                # Mark as undone
-                change['undone'] = True
-                change['undoneAt'] = datetime.now().isoformat()
-                
-                # Revert the change
-                await self.revert_change(filename, change)
-                
-                # Broadcast undo
-                await self.broadcast_to_file(filename, None, {
-                    'type': 'undo',
-                    'filename': filename,
-                    'changeId': change['changeId']
-                })
-                
-                await self.save_file_data(filename)
-                break
+        # Revert the change
+        await self.revert_change(filename, change)
+        
+        # Broadcast undo
+        await self.broadcast_to_file(filename, None, {
+            'type': 'undo',
+            'filename': filename,
+            'changeId': change['changeId']
+        })
+        
+        self.schedule_save(filename)
     
     async def handle_redo(self, client_id, data):
         """Handle redo request"""
@@ -270,24 +423,26 @@ class SyncServer:
             return
         
         # Find the undone change
-        for change in reversed(self.change_history[filename]):
-            if change.get('changeId') == change_id and change.get('undone'):
-                # Unmark as undone
-                change.pop('undone', None)
-                change.pop('undoneAt', None)
-                
-                # Re-apply the change
-                await self.apply_change(filename, change)
-                
-                # Broadcast redo
-                await self.broadcast_to_file(filename, None, {
-                    'type': 'redo',
-                    'filename': filename,
-                    'changeId': change['changeId']
-                })
-                
-                await self.save_file_data(filename)
-                break
+        change = self.change_index[filename].get(change_id)
+        if change is None or not change.get('undone'):
+            return
+        
+        # Unmark as undone; its author can undo it again next
+        change.pop('undone', None)
+        change.pop('undoneAt', None)
+        self.undo_stacks[(filename, change['clientId'])].append(change)
+        
+        # Re-apply the change
+        await self.apply_change(filename, change)
+        
+        # Broadcast redo
+        await self.broadcast_to_file(filename, None, {
+            'type': 'redo',
+            'filename': filename,
+            'changeId': change['changeId']
+        })
+        
+        self.schedule_save(filename)
     
     async def handle_get_history(self, client_id, data):
         """Send change history to client"""
@@ -296,7 +451,7 @@ class SyncServer:
             await self.send_to_client(client_id, {
                 'type': 'history',
                 'filename': filename,
-                'history': self.change_history[filename]
+                'history': list(self.change_history[filename])
             })
     
     async def apply_change(self, filename, change):
@@ -310,32 +465,10 @@ class SyncServer:
         old_value = change.get('oldValue')
         
         # Navigate to the target in the data structure
-        target = self.file_data[filename]
-        for key in path[:-1]:
-            # Handle both dict and list navigation
-            if isinstance(target, dict):
-                if key not in target:
-                    # Determine if next key is numeric (list) or string (dict)
-                    next_key_idx = path.index(key) + 1
-                    if next_key_idx < len(path):
-                        next_key = path[next_key_idx]
-                        target[key] = [] if isinstance(next_key, int) or (isinstance(next_key, str) and next_key.isdigit()) else {}
-                    else:
-                        target[key] = {}
-                target = target[key]
-            elif isinstance(target, list):
-                # Convert key to integer for list access
-                try:
-                    idx = int(key) if isinstance(key, str) else key
-                    if idx < 0 or idx >= len(target):
-                        raise IndexError(f"Index {idx} out of range for list of length {len(target)}")
-                    target = target[idx]
-                except (ValueError, IndexError, TypeError) as e:
-                    print(f"Error navigating path: key={key}, type={type(key)}, target_type={type(target)}, error={e}")
-                    return
-            else:
-                print(f"Error: target is neither dict nor list: {type(target)}")
-                return
+        target = navigate(self.file_data[filename], path, create=True)
+        if target is None:
+            print(f"Error navigating path {path} in {filename}")
+            return
         
         # Store old value if not already stored
         last_key = path[-1]
@@ -400,24 +533,9 @@ class SyncServer:
         old_value = change.get('oldValue')
         
         # Navigate to the target
-        target = self.file_data[filename]
-        for key in path[:-1]:
-            # Handle both dict and list navigation
-            if isinstance(target, dict):
-                if key not in target:
-                    return
-                target = target[key]
-            elif isinstance(target, list):
-                # Convert key to integer for list access
-                try:
-                    idx = int(key) if isinstance(key, str) else key
-                    if idx < 0 or idx >= len(target):
-                        return
-                    target = target[idx]
-                except (ValueError, IndexError, TypeError):
-                    return
-            else:
-                return
+        target = navigate(self.file_data[filename], path)
+        if target is None:
+            return
         
         # Revert the change
         last_key = path[-1]
@@ -456,52 +574,114 @@ class SyncServer:
     
     async def load_file_data(self, filename):
         """Load file data from disk"""
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        saved_files_dir = os.path.join(script_dir, 'saved_files')
-        file_path = os.path.join(saved_files_dir, filename)
+        file_path = os.path.join(self.saved_files_dir, filename)
         
+        data = {}
         if os.path.exists(file_path):
             try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    self.file_data[filename] = json.load(f)
+                data = await asyncio.to_thread(read_json_file, file_path)
             except Exception as e:
                 print(f"Error loading file {filename}: {e}")
-                self.file_data[filename] = {}
-        else:
-            self.file_data[filename] = {}
+        # Another coroutine may have loaded (and edited) the file while this read ran
+        self.file_data.setdefault(filename, data)
     
     async def save_file_data(self, filename):
         """Save file data to disk"""
         if filename not in self.file_data:
             return
         
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        saved_files_dir = os.path.join(script_dir, 'saved_files')
-        os.makedirs(saved_files_dir, exist_ok=True)
-        
-        file_path = os.path.join(saved_files_dir, filename)
+        file_path = os.path.join(self.saved_files_dir, filename)
         try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(self.file_data[filename], f, indent=2, ensure_ascii=False)
+            # Encode here so the data cannot change underneath the encoder;
+            # only the disk write runs off the event loop, one write per file at a time
+            async with self.save_locks[filename]:
+                body = json_dumps(self.file_data[filename], indent=True)
+                await asyncio.to_thread(write_file, file_path, body)
         except Exception as e:
             print(f"Error saving file {filename}: {e}")
     
+    def schedule_save(self, filename):
+        """Save file data after SAVE_DELAY, coalescing edits made in the meantime"""
+        if filename not in self.save_tasks:
+            self.save_tasks[filename] = asyncio.create_task(self.delayed_save(filename))
+    
+    async def delayed_save(self, filename):
+        """Wait out the save delay, then write the file"""
+        await asyncio.sleep(SAVE_DELAY)
+        # Edits from here on schedule a fresh save
+        del self.save_tasks[filename]
+        await self.save_file_data(filename)
+    
+    async def flush_saves(self):
+        """Write every file that still has a delayed save pending"""
+        pending = list(self.save_tasks.items())
+        self.save_tasks.clear()
+        for filename, task in pending:
+            task.cancel()
+            await self.save_file_data(filename)
+    
     async def send_to_client(self, client_id, message):
         """Send message to a specific client"""
-        if client_id in self.clients:
-            try:
-                await self.clients[client_id].send(json.dumps(message))
-            except Exception as e:
-                print(f"Error sending to {client_id}: {e}")
+        self.send_payload(client_id, json_dumps(message))
+    
+    def send_payload(self, client_id, payload):
+        """Queue already-encoded JSON bytes for a specific client"""
+        queue = self.send_queues.get(client_id)
+        if queue is None:
+            return
+        try:
+            queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            # The client is not keeping up; drop it rather than buffer without bound
+            print(f"Send queue full for {client_id}, disconnecting")
+            del self.send_queues[client_id]
+            # The event loop only keeps a weak reference to tasks
+            task = asyncio.create_task(self.close_slow_client(client_id, self.clients[client_id]))
+            self.close_tasks.add(task)
+            task.add_done_callback(self.close_tasks.discard)
+    
+    async def close_slow_client(self, client_id, websocket):
+        """Close a client whose send queue overflowed"""
+        try:
+            await websocket.close(1011, 'Send queue full')
+        except Exception as e:
+            print(f"Error closing {client_id}: {e}")
+    
+    async def client_writer(self, client_id, websocket, queue):
+        """Send one client's queued frames in order, so slow clients only delay themselves"""
+        try:
+            while True:
+                payload = await queue.get()
+                if not queue.empty():
+                    # Frames piled up while the last send was in flight: wrap them
+                    # in one batch message so they go out as a single frame
+                    batch = [payload]
+                    while not queue.empty():
+                        batch.append(queue.get_nowait())
+                    payload = b'{"type":"batch","messages":[' + b','.join(batch) + b']}'
+                # Already-encoded UTF-8 goes out as a text frame without re-encoding
+                if SEND_BYTES_AS_TEXT:
+                    await websocket.send(payload, text=True)
+                else:
+                    await websocket.send(payload.decode('utf-8'))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        except Exception as e:
+            print(f"Error sending to {client_id}: {e}")
     
     async def broadcast_to_file(self, filename, exclude_client_id, message):
         """Broadcast message to all clients in a file session"""
-        if filename not in self.file_sessions:
+        # Snapshot the recipients up front; with nobody else in the session
+        # (the usual single-editor case) the message is never encoded at all
+        recipients = [client_id for client_id in self.file_sessions.get(filename, ())
+                      if client_id != exclude_client_id]
+        if not recipients:
             return
         
-        for client_id in self.file_sessions[filename]:
-            if client_id != exclude_client_id:
-                await self.send_to_client(client_id, message)
+        # Encode once for every recipient; each client's writer task sends it
+        payload = json_dumps(message)
+        for client_id in recipients:
+            self.send_payload(client_id, payload)
 
 def run_websocket_server(port=8001):
     """Run the WebSocket server"""
@@ -516,10 +696,21 @@ def run_websocket_server(port=8001):
     
     async def main():
         try:
-            async with websockets.serve(handler, "0.0.0.0", port):
+            # permessage-deflate would compress every broadcast again for each
+            # recipient; frames are encoded once and sent as-is instead
+            async with websockets.serve(handler, "0.0.0.0", port, compression=None):
                 print(f"WebSocket server listening on 0.0.0.0:{port}")
                 print("Press Ctrl+C to stop")
-                await asyncio.Future()  # Run forever
+                # Run until stopped; SIGTERM ends the wait so pending saves still get written
+                stop = asyncio.get_running_loop().create_future()
+                try:
+                    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set_result, None)
+                except (NotImplementedError, AttributeError):
+                    pass  # No loop signal handlers on Windows
+                try:
+                    await stop
+                finally:
+                    await server.flush_saves()
         except KeyboardInterrupt:
             print("\nWebSocket server stopped.")
         except Exception as e:
@@ -527,7 +718,14 @@ def run_websocket_server(port=8001):
             import traceback
             traceback.print_exc()
     
-    asyncio.run(main())
+    if uvloop is not None and hasattr(uvloop, 'run'):
+        uvloop.run(main())
+    elif uvloop is not None:
+        # uvloop.run() only exists from 0.18 on; older releases install a loop policy
+        uvloop.install()
+        asyncio.run(main())
+    else:
+        asyncio.run(main())
 
 if __name__ == "__main__":
     import sys